@@ -0,0 +1,149 @@
+import functools
+import http.server
+import os
+import tempfile
+import threading
+import time
+
+import webdataset.gopen
+
+from librispeech import ShardCache, ShardStream
+
+
+def serve(root, latency, failures=None):
+    # `failures` maps a path to the number of 503 answers before it is served
+    failures = failures if failures is not None else {}
+
+    class Handler(http.server.SimpleHTTPRequestHandler):
+        def do_GET(self):
+            time.sleep(latency)
+
+            if failures.get(self.path, 0) > 0:
+                failures[self.path] -= 1
+                self.send_error(503)
+                return
+
+            super().do_GET()
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('localhost', 0), functools.partial(Handler, directory=root))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server
+
+
+def slow_gopen(latency):
+    # `gopen` for file:// URLs, with the latency of a remote bucket
+    gopen = webdataset.gopen.gopen
+
+    def open_slowly(url, *args, **kwargs):
+        time.sleep(latency)
+        return gopen(url, *args, **kwargs)
+
+    return open_slowly
+
+
+def check(remote, urls):
+    with tempfile.TemporaryDirectory() as local:
+        cache = ShardCache(local, budget=16 * 2 ** 20, prefetch=2)
+
+        for epoch in range(2):
+            start_time = time.time()
+
+            for i, url in enumerate(urls):
+                path = cache.fetch(url)
+                cache.prefetch(urls[i + 1:])
+
+                with open(path, 'rb') as f, open(os.path.join(remote, os.path.basename(url)), 'rb') as g:
+                    assert f.read() == g.read()
+
+            end_time = time.time()
+
+            print(f'epoch {epoch}: {cache.stats()} in {end_time - start_time:.2f}s')
+
+        assert cache.misses == 1, 'only the first shard should wait for the remote'
+
+        # room for 3 of the 8 shards
+        cache.budget = 3 * 2 ** 20
+        cache.evict()
+
+        size = sum(os.path.getsize(os.path.join(d, n)) for d, _, names in os.walk(local) for n in names)
+        assert size <= cache.budget, 'cache exceeds its budget'
+
+
+def check_missing_index(urls):
+    # shards without an index sidecar: the remote is asked for it once
+    with tempfile.TemporaryDirectory() as local:
+        cache = ShardCache(local, prefetch=0)
+        stream = ShardStream(urls, cache=cache)
+
+        for _ in range(3):
+            stream.open(urls, 0)
+
+        print(f'3 opens without an index: {cache.stats()}')
+
+        assert cache.stats() == {'hits': 2, 'misses': 1}, 'only the first open should miss'
+
+
+def check_transient_errors(remote):
+    # only a 404 is remembered as missing, other errors are retried or raised
+    with open(os.path.join(remote, 'shard-000000.index.json'), 'w') as f:
+        f.write('{"samples": []}')
+
+    failures = {'/shard-000000.index.json': 2, '/shard-000001.index.json': 10}
+    server = serve(remote, latency=0, failures=failures)
+    url = f'http://localhost:{server.server_port}/shard-{{:06d}}.index.json'
+
+    with tempfile.TemporaryDirectory() as local:
+        cache = ShardCache(local)
+
+        assert cache.fetch_optional(url.format(0)) is not None, 'an index was not fetched after two 503s'
+
+        try:
+            cache.fetch_optional(url.format(1), attempts=2)
+        except Exception:
+            pass
+        else:
+            raise AssertionError('persistent 503s were not raised')
+
+        assert not os.path.exists(cache.path(url.format(1)) + '.missing'), 'a 503 was remembered as missing'
+
+        assert cache.fetch_optional(url.format(2)) is None
+        assert os.path.exists(cache.path(url.format(2)) + '.missing'), 'a 404 was not remembered'
+
+    server.shutdown()
+    os.remove(os.path.join(remote, 'shard-000000.index.json'))
+
+    print('index sidecars: 503 retried then raised, 404 remembered as missing')
+
+
+def main():
+    with tempfile.TemporaryDirectory() as remote:
+        for i in range(8):
+            with open(os.path.join(remote, f'shard-{i:06d}.tar'), 'wb') as f:
+                f.write(os.urandom(2 ** 20))
+
+        server = serve(remote, latency=0.2)
+
+        print('http://')
+        urls = [f'http://localhost:{server.server_port}/shard-{i:06d}.tar' for i in range(8)]
+        check(remote, urls)
+        check_missing_index(urls)
+
+        server.shutdown()
+
+        check_transient_errors(remote)
+
+        # everything that is not http(s) goes through webdataset's gopen, e.g. gs:// with gsutil
+        webdataset.gopen.gopen = slow_gopen(latency=0.2)
+
+        print('file://')
+        urls = [f'file://{remote}/shard-{i:06d}.tar' for i in range(8)]
+        check(remote, urls)
+        check_missing_index(urls)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+import collections
+import glob
+import os
+import tempfile
+
+import soundfile
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from librispeech import LibriSpeech
+from readdataset import make_synthetic_shards
+
+
+def summary(x, lengths):
+    # stands in for the model: the length and sum of every unpadded utterance
+    valid = torch.arange(x.size(-1)) < lengths.unsqueeze(1)
+    return torch.stack([lengths.to(x), (x * valid).sum(-1)], dim=1)
+
+
+def _check(rank, world_size, url, keys, expected):
+    # needs `src` on the path, e.g. PYTHONPATH=src
+    from misc.collector import EmbeddingCollector
+
+    os.environ['MASTER_ADDR'] = 'localhost'
+    os.environ['MASTER_PORT'] = '29501'
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
+
+    datamodule = LibriSpeech(url, url, url, batch_size=8, eval_batch_size=4, eval_window=8)
+    datamodule.num_workers = 2
+    datamodule.setup('fit')
+
+    collector = EmbeddingCollector(keys, 2)
+    counts = collections.Counter()
+
+    for x, lengths, batch_keys in datamodule.val_dataloader():
+        collector.update(batch_keys, summary(x, lengths))
+        counts.update(batch_keys)
+
+    gathered = [None] * world_size
+    dist.all_gather_object(gathered, counts)
+
+    total = sum(gathered, collections.Counter())
+    assert set(total) == set(keys), f'rank {rank}: utterances missing from the dev set'
+    assert all(count == 1 for count in total.values()), f'rank {rank}: an utterance was read by two streams'
+    sizes = [sum(counts.values()) for counts in gathered]
+    assert max(sizes) - min(sizes) <= 2, f'rank {rank}: ranks read {sizes} utterances'
+
+    embeddings = collector.gather()
+    assert torch.allclose(embeddings, expected, atol=1e-3), f'rank {rank}: gathered embeddings differ'
+
+    dist.destroy_process_group()
+
+
+def check(num_shards, world_size=2):
+    with tempfile.TemporaryDirectory() as root:
+        urls = make_synthetic_shards(root, num_shards=num_shards, samples_per_shard=30 // num_shards)
+        url = os.path.join(root, f'synthetic-flac-{{000000..{num_shards - 1:06d}}}.tar')
+
+        paths = sorted(glob.glob(os.path.join(root, 'audio', '*.flac')))
+        keys = [os.path.splitext(os.path.basename(path))[0] for path in paths]
+
+        waveforms = [torch.from_numpy(soundfile.read(path, dtype='float32')[0]) for path in paths]
+        expected = torch.stack([torch.stack([torch.tensor(len(w), dtype=torch.float32), w.sum()]) for w in waveforms])
+
+        mp.spawn(_check, args=(world_size, url, keys, expected), nprocs=world_size)
+
+        print(f'{len(keys)} dev utterances from {len(urls)} shards collected once by {world_size} gloo ranks.')
+
+
+def main():
+    # dev and test are a single shard each, shared by every rank and worker
+    for num_shards in [1, 5]:
+        check(num_shards)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+import collections
+import io
+import os
+import tarfile
+import tempfile
+
+import torch
+
+from librispeech import LibriSpeech, ShardStream, read_shard
+from makeshards import write_index
+from readdataset import make_synthetic_shards
+
+
+def make_shards(root, num_shards=19, indexed=True):
+    urls = []
+
+    for shard in range(num_shards):
+        url = os.path.join(root, f'shard-{shard:06d}.tar')
+
+        with tarfile.open(url, 'w') as tar:
+            # uneven shard sizes
+            for i in range(10 + shard % 7):
+                data = f'{shard}'.encode('utf-8')
+                info = tarfile.TarInfo(f'{shard:06d}-{i:04d}.speaker.id')
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+
+        if indexed:
+            write_index(url)
+
+        urls.append(url)
+
+    return urls
+
+
+def read(stream, rank, world_size, epoch, positions=None, limit=None):
+    stream.rank = rank
+    stream.world_size = world_size
+    stream.epoch = epoch
+    stream.positions = positions or {}
+
+    dataloader = torch.utils.data.DataLoader(stream, num_workers=4, batch_size=None)
+
+    keys = []
+    last = {}
+
+    for sample in dataloader:
+        if limit is not None and len(keys) == limit:
+            break
+
+        keys.append(sample['__key__'])
+        position = sample['__position__']
+        last[position['stream']] = dict({key: value for key, value in position.items() if key != 'stream'}, rng=None)
+
+    return keys, last
+
+
+def check(urls, world_size=2, interleave=1, indexed=True):
+    expected = {os.path.basename(url)[len('shard-'):-len('.tar')] for url in urls}
+    stream = ShardStream(urls, interleave=interleave)
+
+    # as in `LibriSpeech.start_epoch`, which refuses DDP training without indexes
+    if indexed:
+        stream.load_sizes()
+
+    for epoch in range(3):
+        counts = collections.Counter()
+        per_rank = []
+
+        for rank in range(world_size):
+            keys, _ = read(stream, rank, world_size, epoch)
+            counts.update(keys)
+            per_rank.append(len(keys))
+
+        assert all(count == 1 for count in counts.values()), 'a sample was read twice'
+
+        if indexed:
+            stream.epoch = epoch
+            quota = sum(stream.quota(worker, 4) for worker in range(4))
+            assert per_rank == [quota] * world_size, f'ranks read {per_rank} samples, not {quota} each'
+        else:
+            assert {key.split('-')[0] for key in counts} == expected, 'a shard was not read'
+            assert sum(counts.values()) == sum(10 + shard % 7 for shard in range(len(urls)))
+
+        # interrupted after a few samples per rank, then resumed from the saved positions
+        resumed = collections.Counter()
+
+        for rank in range(world_size):
+            keys, positions = read(stream, rank, world_size, epoch, limit=23)
+            resumed.update(keys)
+            keys, _ = read(stream, rank, world_size, epoch, positions)
+            resumed.update(keys)
+
+        assert resumed == counts, 'resuming lost or repeated samples'
+
+    print(
+        f'{world_size} ranks x 4 workers, {interleave} open shards, {"indexed" if indexed else "no indexes"}: '
+        f'{per_rank} samples per rank, once per epoch, also across a resume.'
+    )
+
+
+def check_shuffle(root, length=600, window=256):
+    # shards without an index are permuted within windows, and resumed at any sample
+    url = os.path.join(root, 'long.tar')
+
+    with tarfile.open(url, 'w') as tar:
+        for i in range(length):
+            info = tarfile.TarInfo(f'{i:06d}.speaker.id')
+            info.size = 1
+            tar.addfile(info, io.BytesIO(b'0'))
+
+    def keys(start=0, seed='1234-0-long'):
+        return [sample['__key__'] for sample in read_shard(url, start, seed, window)]
+
+    order = keys()
+
+    assert sorted(order) == [f'{i:06d}' for i in range(length)], 'a sample was lost or repeated'
+    assert order != sorted(order), 'the shard was not shuffled'
+    assert keys(seed='1234-1-long') != order, 'every epoch has the same order'
+
+    for start in [1, window - 1, window, window + 7, length - 1, length]:
+        assert keys(start) == order[start:], f'resuming at {start} changed the order'
+
+    print(f'{length} samples without an index shuffled within windows of {window}, also across a resume.')
+
+
+def check_reused_buffers(root):
+    # zero-copy batches stay intact while the consumer keeps every one of them
+    urls = make_synthetic_shards(root, num_shards=4, samples_per_shard=32)
+
+    datamodule = LibriSpeech(urls, urls, urls, batch_size=4, zero_copy=True)
+    datamodule.num_workers = 2
+    datamodule.trainset = datamodule.make_dataset(urls)
+
+    held = []
+
+    for batch in datamodule.train_dataloader():
+        x, _ = datamodule.on_before_batch_transfer(batch, 0)
+        held.append((x, x.sum().item()))
+
+    assert all(torch.isclose(x.sum(), torch.tensor(total)) for x, total in held), 'a kept batch was overwritten'
+
+    print(f'{len(held)} zero-copy batches kept intact until the end of the epoch.')
+
+
+def main():
+    with tempfile.TemporaryDirectory() as root:
+        check_shuffle(root)
+
+    with tempfile.TemporaryDirectory() as root:
+        check_reused_buffers(root)
+
+    for indexed in [True, False]:
+        with tempfile.TemporaryDirectory() as root:
+            urls = make_shards(root, indexed=indexed)
+
+            for interleave in [1, 3]:
+                check(urls, interleave=interleave, indexed=indexed)
+
+
+if __name__ == '__main__':
+    main()
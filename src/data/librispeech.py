@@ -1,6 +1,24 @@
+import collections
+import concurrent.futures
+import functools
+import hashlib
 import io
+import itertools
+import json
+import mmap
+import os
 import random
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
 
+import braceexpand
+import numpy as np
 import pytorch_lightning as lightning
 import soundfile
 import torch
@@ -11,6 +29,107 @@ def flac_handler_soundfile(b):
     return torch.from_numpy(soundfile.read(io.BytesIO(b))[0].astype('float32'))
 
 
+def pcm16_handler(b):
+    # read-only int16 view of the sample bytes, no copy
+    return np.frombuffer(b, dtype='<i2')
+
+
+def pcm16_to_float(waveform):
+    # the only copy, same scale as `soundfile.read`
+    return torch.from_numpy(waveform.astype(np.float32)).mul_(1 / 32768)
+
+
+def pcm16_handler_float(b):
+    return pcm16_to_float(pcm16_handler(b))
+
+
+def pcm16_crop_into(b, out):
+    # crop the int16 view first so that only the cropped samples are converted, into `out`
+    waveform = pcm16_handler(b)
+
+    length = len(waveform)
+    crop_length = out.shape[-1]
+
+    if length > crop_length:
+        start = random.randint(0, length - crop_length - 1)
+        waveform = waveform[start:start+crop_length]
+
+    np.multiply(waveform, np.float32(1 / 32768), out=out[:len(waveform)])
+    out[len(waveform):] = 0
+
+
+def pcm16_crop_handler(b, crop_length=int(1.5 * 16000)):
+    result = torch.empty(crop_length)
+    pcm16_crop_into(b, result.numpy())
+    return result
+
+
+def flac_crop_into(b, out):
+    # the frame count comes from the FLAC header, so only the cropped window is decoded
+    crop_length = out.shape[-1]
+
+    with soundfile.SoundFile(io.BytesIO(b)) as f:
+        length = f.frames
+
+        if length > crop_length:
+            start = random.randint(0, length - crop_length - 1)
+            f.seek(start)
+            f.read(crop_length, dtype='float32', out=out)
+        else:
+            f.read(length, dtype='float32', out=out[:length])
+            out[length:] = 0
+
+
+def flac_crop_handler(b, crop_length=int(1.5 * 16000)):
+    result = torch.empty(crop_length)
+    flac_crop_into(b, result.numpy())
+    return result
+
+
+def logmel_handler(b):
+    # (n_mels, frames) float16 features written by `makeshards`, normalized per utterance
+    features = torch.from_numpy(np.load(io.BytesIO(b)).astype(np.float32))
+    return features - features.mean(dim=1, keepdim=True)
+
+
+def logmel_crop_into(b, out):
+    # random crop in the frame domain, normalized after cropping like the online frontend
+    features = np.load(io.BytesIO(b))
+
+    length = features.shape[1]
+    crop_frames = out.shape[-1]
+
+    if length > crop_frames:
+        start = random.randint(0, length - crop_frames - 1)
+        features = features[:, start:start+crop_frames]
+
+    valid = out[:, :features.shape[1]]
+    valid[...] = features
+    valid -= valid.mean(axis=1, keepdims=True)
+    out[:, features.shape[1]:] = 0
+
+
+def logmel_crop_handler(b, crop_frames=150):
+    result = torch.empty(80, crop_frames)
+    logmel_crop_into(b, result.numpy())
+    return result
+
+
+# sample key, cropping handler for training and full-length handler for evaluation
+FORMATS = {
+    'flac': ("waveform.flac", flac_crop_handler, flac_handler_soundfile),
+    'pcm16': ("waveform.pcm16", pcm16_crop_handler, pcm16_handler_float),
+    'logmel': ("logmel.npy", logmel_crop_handler, logmel_handler),
+}
+
+# cropping into a preallocated row, and the shape of a cropped sample
+CROP_INTO = {
+    'flac': (flac_crop_into, (int(1.5 * 16000),)),
+    'pcm16': (pcm16_crop_into, (int(1.5 * 16000),)),
+    'logmel': (logmel_crop_into, (80, 150)),
+}
+
+
 def random_crop(data, crop_length=int(1.5 * 16000)):
     waveform, spk = data
 
@@ -27,34 +146,785 @@ def random_crop(data, crop_length=int(1.5 * 16000)):
     return result, spk
 
 
+def pad_batch(samples):
+    # pads the last dimension, samples of waveforms or frames of features
+    waveforms, labels = zip(*samples)
+
+    lengths = torch.tensor([waveform.size(-1) for waveform in waveforms])
+    batch = torch.zeros(len(waveforms), *waveforms[0].shape[:-1], int(lengths.max()))
+
+    for i, waveform in enumerate(waveforms):
+        batch[i, ..., :waveform.size(-1)] = waveform
+
+    return batch, lengths, list(labels)
+
+
+def bucket_by_length(data, batch_size, window=512):
+    # sort each window of `window` utterances by length so that a batch holds similar lengths
+    buffer = []
+
+    for sample in data:
+        buffer.append(sample)
+
+        if len(buffer) < window:
+            continue
+
+        buffer.sort(key=lambda sample: sample[0].size(-1), reverse=True)
+
+        for start in range(0, len(buffer), batch_size):
+            yield pad_batch(buffer[start:start+batch_size])
+
+        buffer = []
+
+    buffer.sort(key=lambda sample: sample[0].size(-1), reverse=True)
+
+    for start in range(0, len(buffer), batch_size):
+        yield pad_batch(buffer[start:start+batch_size])
+
+
+def collate(samples):
+    xs, labels = zip(*samples)
+    return torch.stack(xs), torch.tensor(labels)
+
+
+def speaker_batches(data, speakers=32, utterances=4, capacity=4096):
+    # Batches of `speakers` x `utterances` samples drawn from per-speaker reservoirs.
+    # At most `capacity` samples are buffered; when it is reached before enough speakers
+    # are complete, the batch is topped up from the fullest reservoirs. No sample is dropped.
+    batch_size = speakers * utterances
+
+    reservoirs = collections.defaultdict(list)
+    ready = {}
+    size = 0
+
+    def take(spk, count):
+        nonlocal size
+
+        reservoir = reservoirs[spk]
+        taken, reservoirs[spk] = reservoir[:count], reservoir[count:]
+        size -= len(taken)
+
+        if len(reservoirs[spk]) < utterances:
+            ready.pop(spk, None)
+        if not reservoirs[spk]:
+            del reservoirs[spk]
+
+        return taken
+
+    for sample in data:
+        spk = sample[1]
+
+        reservoirs[spk].append(sample)
+        size += 1
+
+        if len(reservoirs[spk]) >= utterances:
+            ready[spk] = None
+
+        if len(ready) < speakers and size < capacity:
+            continue
+
+        batch = []
+
+        for spk in random.sample(list(ready), min(speakers, len(ready))):
+            batch += take(spk, utterances)
+
+        while len(batch) < batch_size and reservoirs:
+            spk = max(reservoirs, key=lambda spk: len(reservoirs[spk]))
+            batch += take(spk, min(utterances, batch_size - len(batch)))
+
+        yield collate(batch)
+
+    # end of the stream, the rest in full batches where possible
+    rest = [sample for reservoir in reservoirs.values() for sample in reservoir]
+
+    for start in range(0, len(rest), batch_size):
+        yield collate(rest[start:start+batch_size])
+
+
+def index_path(url):
+    # sidecar written next to each shard by `makeshards`
+    return os.path.splitext(url)[0] + '.index.json'
+
+
+def read_index(url):
+    with open_url(index_path(url)) as f:
+        return json.load(f)['samples']
+
+
+def assign_shards(urls, epoch, seed, rank=0, world_size=1, worker=0, num_workers=1):
+    # the same shuffle on every process, then a disjoint slice per (rank, worker) stream
+    urls = list(urls)
+    random.Random(f'{seed}-{epoch}').shuffle(urls)
+    return urls[rank * num_workers + worker::world_size * num_workers]
+
+
+
+
+def open_url(url):
+    if urllib.parse.urlparse(url).scheme in ['http', 'https']:
+        return urllib.request.urlopen(url)
+    return webdataset.gopen.gopen(url, 'rb')
+
+
+def not_found(url, error):
+    # whether `open_url` failed because the remote has no such file
+    if isinstance(error, FileNotFoundError):
+        return True
+
+    if isinstance(error, urllib.error.HTTPError):
+        return error.code == 404
+
+    if urllib.parse.urlparse(url).scheme == 'gs':
+        # gsutil only reports an exit status through `gopen`, so the object is looked up
+        result = subprocess.run(['gsutil', 'stat', url], capture_output=True)
+        return result.returncode != 0 and b'No URLs matched' in result.stderr
+
+    return False
+
+
+class ShardCache:
+    # Read-through cache of remote shards in a local directory. Files are written under a
+    # temporary name and renamed into place, the least recently used ones are deleted
+    # once the cache exceeds `budget` bytes. Shared by all processes using `root`.
+    def __init__(self, root, budget=64 * 2 ** 30, prefetch=2):
+        self.root = root
+        self.budget = budget
+        self.prefetch_count = prefetch
+
+        self.hits = 0
+        self.misses = 0
+
+        self.executor = None
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        # every dataloader worker starts with its own threads and counters
+        state = self.__dict__.copy()
+        state['executor'] = None
+        state['pending'] = {}
+        state['lock'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def path(self, url):
+        # files of the same remote directory stay together, e.g. a shard and its index
+        directory, name = url.rsplit('/', 1) if '/' in url else ('', url)
+        return os.path.join(self.root, hashlib.sha1(directory.encode('utf-8')).hexdigest()[:16], name)
+
+    def fetch(self, url):
+        path = self.path(url)
+
+        with self.lock:
+            future = self.pending.pop(url, None)
+
+        if future is not None:
+            # prefetched in the background, wait for it if it is still running
+            future.result()
+
+        if os.path.exists(path):
+            self.hits += 1
+            # mark as recently used
+            os.utime(path)
+            return path
+
+        self.download(url)
+        self.misses += 1
+
+        return path
+
+    def fetch_optional(self, url, attempts=3):
+        # `fetch` of a file the remote may not have, e.g. an index sidecar. When the remote
+        # reports it missing, a marker is left so that later lookups do not ask again; other
+        # errors are retried, then raised.
+        marker = self.path(url) + '.missing'
+
+        if os.path.exists(marker):
+            return None
+
+        for attempt in range(attempts):
+            try:
+                return self.fetch(url)
+            except Exception as e:
+                if not_found(url, e):
+                    os.makedirs(os.path.dirname(marker), exist_ok=True)
+                    open(marker, 'wb').close()
+                    return None
+
+                if attempt == attempts - 1:
+                    raise
+
+                time.sleep(2 ** attempt)
+
+    def download(self, url):
+        path = self.path(url)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+
+        try:
+            with os.fdopen(fd, 'wb') as dst, open_url(url) as src:
+                shutil.copyfileobj(src, dst, 2 ** 20)
+            os.replace(tmp, path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+        self.evict(keep=path)
+
+    def evict(self, keep=None):
+        files = []
+
+        for directory, _, names in os.walk(self.root):
+            for name in names:
+                if name.endswith('.tmp'):
+                    continue
+                path = os.path.join(directory, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    # evicted by another process
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in files)
+
+        for _, size, path in sorted(files):
+            if total <= self.budget:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def prefetch(self, urls):
+        # download the next shards in a background thread while the current one is read
+        if self.executor is None:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+        for url in urls[:self.prefetch_count]:
+            with self.lock:
+                if url in self.pending or os.path.exists(self.path(url)):
+                    continue
+                self.pending[url] = self.executor.submit(self.download, url)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+def shuffle_windows(samples, start=0, seed=None, window=256):
+    # Samples permuted within consecutive windows of `window`, each by its own seed, from the
+    # `start`-th after permutation on. Skipped windows are read but not kept.
+    samples = itertools.islice(samples, start // window * window, None)
+
+    for i in itertools.count(start // window):
+        buffer = list(itertools.islice(samples, window))
+
+        if not buffer:
+            return
+
+        if seed is not None:
+            random.Random(f'{seed}-{i}').shuffle(buffer)
+
+        yield from buffer[start - i * window if start > i * window else 0:]
+
+
+def read_shard(url, start=0, seed=None, window=256):
+    # Samples of a shard from the `start`-th on, shuffled by `seed`. With an index sidecar
+    # the whole shard is permuted and `start` is a direct seek; otherwise it is read in order
+    # and permuted within windows of `window` samples.
+    if not os.path.exists(index_path(url)):
+        samples = webdataset.tariterators.tarfile_samples([{'url': url}])
+        yield from shuffle_windows(samples, start, seed, window)
+        return
+
+    samples = read_index(url)
+
+    order = list(range(len(samples)))
+    if seed is not None:
+        random.Random(seed).shuffle(order)
+
+    with open(url, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+        for i in order[start:]:
+            sample = samples[i]
+            result = {'__key__': sample['key'], '__url__': url}
+
+            for extension, (offset, size) in sample['members'].items():
+                result[extension] = buffer[offset:offset+size]
+
+            yield result
+
+
+def split_samples(shards, rank=0, world_size=1):
+    # Samples of all shards dealt in turn to the (rank, worker) streams, so that even a single
+    # shard is shared by all of them. Each stream reads every shard but decodes only its own.
+    info = torch.utils.data.get_worker_info()
+    worker, num_workers = (info.id, info.num_workers) if info is not None else (0, 1)
+
+    samples = itertools.chain.from_iterable(read_shard(shard['url']) for shard in shards)
+    yield from itertools.islice(samples, rank * num_workers + worker, None, world_size * num_workers)
+
+
+class SampleBuffer:
+    # queue of samples bounded by their size in bytes, filled by a reader thread
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.items = collections.deque()
+        self.size = 0
+        self.closed = False
+        self.condition = threading.Condition()
+
+    def put(self, item, size=0):
+        with self.condition:
+            # a sample larger than the capacity still goes into an empty buffer
+            self.condition.wait_for(lambda: self.closed or not self.items or self.size + size <= self.capacity)
+
+            if self.closed:
+                return False
+
+            self.items.append((item, size))
+            self.size += size
+            self.condition.notify_all()
+
+            return True
+
+    def get(self):
+        with self.condition:
+            self.condition.wait_for(lambda: self.items)
+
+            item, size = self.items.popleft()
+            self.size -= size
+            self.condition.notify_all()
+
+            return item
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+
+class ShardStream(torch.utils.data.IterableDataset):
+    # Shards are shuffled per epoch and split by DDP rank and dataloader worker. Each worker
+    # keeps `interleave` shards open, read ahead by one thread each into buffers of
+    # `buffer_bytes`, and takes samples from them in turn, so a stalled shard does not stall
+    # the worker. Every sample carries the position of its stream after it, so that an epoch
+    # can be resumed from `positions`, a dict of stream -> {'next', 'open', 'count', 'turn', 'rng'}.
+    # Once `sizes` are loaded, every rank yields the same number of samples per epoch.
+    def __init__(self, urls, seed=1234, cache=None, interleave=1, buffer_bytes=64 * 2 ** 20):
+        if isinstance(urls, str):
+            urls = list(braceexpand.braceexpand(urls))
+
+        self.urls = urls
+        self.seed = seed
+        self.cache = cache
+        self.interleave = interleave
+        self.buffer_bytes = buffer_bytes
+
+        self.epoch = 0
+        self.rank = 0
+        self.world_size = 1
+        self.positions = {}
+
+        # samples per shard
+        self.sizes = None
+
+    def shards(self, worker=0, num_workers=1):
+        return assign_shards(self.urls, self.epoch, self.seed, self.rank, self.world_size, worker, num_workers)
+
+    def load_sizes(self):
+        # read once from the index sidecars, in the main process
+        if self.sizes is not None:
+            return
+
+        try:
+            self.sizes = {url: len(read_index(url)) for url in self.urls}
+        except Exception as e:
+            raise ValueError('Every rank running the same number of steps needs an index sidecar for every shard') from e
+
+    def quota(self, worker=0, num_workers=1):
+        # Samples the stream of `worker` yields this epoch: the fewest the same worker has on
+        # any rank, so that all ranks run the same number of steps. The rest waits for an
+        # epoch which assigns its shard differently.
+        if self.sizes is None or self.world_size == 1:
+            return None
+
+        return min(
+            sum(self.sizes[url] for url in assign_shards(self.urls, self.epoch, self.seed, rank, self.world_size, worker, num_workers))
+            for rank in range(self.world_size)
+        )
+
+    def open(self, shards, shard):
+        # local path of a shard, through the cache when there is one
+        url = shards[shard]
+
+        if self.cache is None:
+            return url
+
+        # shards without an index are read sequentially
+        self.cache.fetch_optional(index_path(url))
+
+        path = self.cache.fetch(url)
+        self.cache.prefetch(shards[shard + 1:])
+
+        return path
+
+    def fill(self, buffer, shards, shard, start):
+        # reader thread of one shard, ends with None or the exception it raised
+        try:
+            url = shards[shard]
+            samples = read_shard(self.open(shards, shard), start, f'{self.seed}-{self.epoch}-{url}')
+
+            for sample in samples:
+                size = sum(len(value) for value in sample.values() if isinstance(value, bytes))
+
+                if not buffer.put(sample, size):
+                    return
+
+            buffer.put(None)
+        except Exception as e:
+            buffer.put(e)
+
+    def __iter__(self):
+        info = torch.utils.data.get_worker_info()
+        worker, num_workers = (info.id, info.num_workers) if info is not None else (0, 1)
+
+        stream = self.rank * num_workers + worker
+        shards = self.shards(worker, num_workers)
+
+        position = self.positions.get(stream, {'next': 0, 'open': {}, 'count': 0, 'rng': None})
+
+        quota = self.quota(worker, num_workers)
+        count = position.get('count', 0)
+
+        # random cropping continues exactly where it stopped
+        if position['rng'] is not None:
+            random.setstate(position['rng'])
+
+        # [shard, samples read, buffer] of every open shard
+        slots = []
+        following = position['next']
+
+        def start(shard, offset):
+            buffer = SampleBuffer(self.buffer_bytes)
+            threading.Thread(target=self.fill, args=(buffer, shards, shard, offset), daemon=True).start()
+            slots.append([shard, offset, buffer])
+
+        for shard, offset in sorted(position['open'].items()):
+            start(shard, offset)
+
+        while len(slots) < self.interleave and following < len(shards):
+            start(following, 0)
+            following += 1
+
+        try:
+            # the open shards take turns in order, from where the position left off
+            turn = position.get('turn', 0)
+
+            while slots and (quota is None or count < quota):
+                turn %= len(slots)
+                slot = slots[turn]
+
+                sample = slot[2].get()
+
+                if isinstance(sample, Exception):
+                    raise sample
+
+                if sample is None:
+                    slots.pop(turn)
+
+                    if following < len(shards):
+                        start(following, 0)
+                        following += 1
+
+                    continue
+
+                slot[1] += 1
+                turn += 1
+                count += 1
+
+                sample['__position__'] = {
+                    'stream': stream,
+                    'next': following,
+                    'open': {shard: offset for shard, offset, _ in slots},
+                    'count': count,
+                    'turn': turn,
+                }
+
+                yield sample
+        finally:
+            for _, _, buffer in slots:
+                buffer.close()
+
+
+def positioned_batches(data, batch_size):
+    # (x, label, position) samples to batches with the position after their last sample
+    batch = []
+
+    for x, label, position in data:
+        batch.append((x, label))
+
+        if len(batch) == batch_size:
+            yield (*collate(batch), dict(position, rng=random.getstate()))
+            batch = []
+
+    if batch:
+        yield (*collate(batch), dict(position, rng=random.getstate()))
+
+
+def cropped_batches(data, batch_size, fmt='flac', depth=4, share=None):
+    # (bytes, label, position) samples cropped straight into preallocated batch buffers, in
+    # shared memory inside a dataloader worker so that a batch reaches the main process
+    # without a copy. A buffer is reused `depth` batches later, so it has to be copied out
+    # before: `StreamLoader` with `reused` does that as soon as a batch arrives.
+    crop_into, shape = CROP_INTO[fmt]
+
+    if share is None:
+        share = torch.utils.data.get_worker_info() is not None
+
+    buffers = [None] * depth
+    count = 0
+    labels = []
+
+    for b, label, position in data:
+        if not labels:
+            slot = count % depth
+
+            if buffers[slot] is None:
+                buffers[slot] = torch.empty(batch_size, *shape)
+
+                if share:
+                    buffers[slot].share_memory_()
+
+            x = buffers[slot]
+
+        crop_into(b, x[len(labels)].numpy())
+        labels.append(int(label))
+
+        if len(labels) == batch_size:
+            yield x, torch.tensor(labels), dict(position, rng=random.getstate())
+            count += 1
+            labels = []
+
+    if labels:
+        yield x[:len(labels)], torch.tensor(labels), dict(position, rng=random.getstate())
+
+
+class StreamLoader(torch.utils.data.DataLoader):
+    # Calls `on_iter` in the main process before workers copy the dataset for an epoch. With
+    # `reused`, batches come from `cropped_batches` buffers and are copied out as soon as they
+    # arrive, by pinning or else by a clone, so that consumers may keep them.
+    def __init__(self, dataset, on_iter=None, reused=False, **kwargs):
+        super().__init__(dataset, **kwargs)
+        self.on_iter = on_iter
+        self.reused = reused
+
+    def __iter__(self):
+        if self.on_iter is not None:
+            self.on_iter()
+
+        batches = super().__iter__()
+
+        if not self.reused:
+            return batches
+
+        return (batch if batch[0].is_pinned() else (batch[0].clone(), *batch[1:]) for batch in batches)
+
+
 class LibriSpeech(lightning.LightningDataModule):
-    def __init__(self, url_train, url_dev, url_test, batch_size):
+    def __init__(
+        self,
+        url_train,
+        url_dev,
+        url_test,
+        batch_size,
+        eval_batch_size=16,
+        eval_window=512,
+        fmt='flac',
+        speakers_per_batch=None,
+        seed=1234,
+        cache_dir=None,
+        cache_budget=64 * 2 ** 30,
+        prefetch=2,
+        interleave=4,
+        buffer_bytes=64 * 2 ** 20,
+        zero_copy=False,
+        pin_memory=False,
+    ):
         super().__init__()
         self.url_train = url_train
         self.url_dev = url_dev
         self.url_test = url_test
         self.batch_size = batch_size
+        self.eval_batch_size = eval_batch_size
+        self.eval_window = eval_window
+        self.fmt = fmt
+        self.num_workers = 4
+        self.prefetch_factor = 2
+
+        # P speakers x K utterances training batches, with K = batch_size // P
+        self.speakers_per_batch = speakers_per_batch
+
+        # training stream state, saved in checkpoints
+        self.seed = seed
+        self.epoch = -1
+        self.positions = {}
+        self.resuming = False
+        self.stream = None
+
+        # local read-through cache for remote training shards
+        self.cache = ShardCache(cache_dir, cache_budget, prefetch) if cache_dir is not None else None
+
+        # shards read concurrently by each worker, and the read-ahead per shard
+        self.interleave = interleave
+        self.buffer_bytes = buffer_bytes
+
+        # crops written into reused shared memory batches, and copied once into pinned memory
+        # so that Lightning's non_blocking transfer overlaps with compute, or else cloned
+        self.zero_copy = zero_copy
+        self.pin_memory = pin_memory
 
     def make_dataset(self, url, label='speaker.id'):
-        transform = random_crop
+        # decoding and random cropping happen in one step
+        key, handler, _ = FORMATS[self.fmt]
+
+        self.stream = ShardStream(url, self.seed, self.cache, self.interleave, self.buffer_bytes)
+
+        if self.trainer is not None:
+            self.stream.rank = self.trainer.global_rank
+            self.stream.world_size = self.trainer.world_size
+
+        if self.speakers_per_batch is None and self.zero_copy:
+            # raw bytes, decoded by the collation stage
+            dataset = webdataset.DataPipeline(
+                self.stream,
+                webdataset.to_tuple(key, label, '__position__'),
+            )
+            # buffers of a worker not yet copied out: those the loader has asked for, including
+            # the one being cropped, and one in the pin memory thread
+            depth = self.prefetch_factor + 2
+
+            dataset = dataset.compose(functools.partial(
+                cropped_batches, batch_size=self.batch_size, fmt=self.fmt, depth=depth
+            ))
+        elif self.speakers_per_batch is None:
+            dataset = webdataset.DataPipeline(
+                self.stream,
+                webdataset.decode(webdataset.handle_extension(key, handler)),
+                webdataset.to_tuple(key, label, '__position__'),
+            )
+            dataset = dataset.compose(functools.partial(positioned_batches, batch_size=self.batch_size))
+        else:
+            # Each dataloader worker balances the speakers of its own shards. Samples held in
+            # the reservoirs have no position, so an interrupted epoch restarts from its beginning.
+            dataset = webdataset.DataPipeline(
+                self.stream,
+                webdataset.decode(webdataset.handle_extension(key, handler)),
+                webdataset.to_tuple(key, label),
+            )
+            dataset = dataset.compose(functools.partial(
+                speaker_batches,
+                speakers=self.speakers_per_batch,
+                utterances=self.batch_size // self.speakers_per_batch
+            ))
+
+        return dataset
+
+    def start_epoch(self):
+        # a restored position is used once, afterwards every iteration is a new epoch
+        if self.resuming:
+            self.resuming = False
+        else:
+            self.epoch += 1
+            self.positions = {}
+
+        self.stream.rank, self.stream.world_size = self.distributed()
+
+        if self.stream.world_size > 1:
+            self.stream.load_sizes()
+
+        self.stream.seed = self.seed
+        self.stream.epoch = self.epoch
+        self.stream.positions = dict(self.positions)
+
+    def on_before_batch_transfer(self, batch, dataloader_idx):
+        # training batches carry the position of their stream
+        if isinstance(batch[-1], dict):
+            position = dict(batch[-1])
+            self.positions[position.pop('stream')] = position
+            batch = batch[:-1]
+
+        return batch
+
+    def state_dict(self):
+        positions = self.positions
+
+        # every rank only sees its own streams
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            gathered = [None] * torch.distributed.get_world_size()
+            torch.distributed.all_gather_object(gathered, positions)
+            positions = {stream: p for rank in gathered for stream, p in rank.items()}
+
+        return {'seed': self.seed, 'epoch': self.epoch, 'positions': positions}
+
+    def load_state_dict(self, state_dict):
+        self.seed = state_dict['seed']
+        self.epoch = state_dict['epoch']
+        self.positions = state_dict['positions']
+        self.resuming = True
+
+    def distributed(self):
+        # (rank, world size) of this process
+        if self.trainer is not None:
+            return self.trainer.global_rank, self.trainer.world_size
+
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            return torch.distributed.get_rank(), torch.distributed.get_world_size()
+
+        return 0, 1
+
+    def make_eval_dataset(self, url, label='__key__'):
+        # Full-length utterances as (padded waveforms, lengths, labels), the samples split by
+        # DDP rank and dataloader worker. The rank is taken here, since spawned dataloader
+        # workers do not see the process group.
+        bucket = functools.partial(bucket_by_length, batch_size=self.eval_batch_size, window=self.eval_window)
+
+        key, _, handler = FORMATS[self.fmt]
+
+        rank, world_size = self.distributed()
 
-        return webdataset.WebDataset(url) \
-            .shuffle(1000) \
-            .decode(webdataset.handle_extension("flac", flac_handler_soundfile)) \
-            .to_tuple("waveform.flac", label) \
-            .map(transform) \
-            .batched(self.batch_size)
+        return webdataset.DataPipeline(
+            webdataset.SimpleShardList(url),
+            functools.partial(split_samples, rank=rank, world_size=world_size),
+            webdataset.decode(webdataset.handle_extension(key, handler)),
+            webdataset.to_tuple(key, label),
+        ).compose(bucket)
 
     def setup(self, stage):
         self.trainset = self.make_dataset(self.url_train)
-        self.devset = self.make_dataset(self.url_dev, '__key__')
-        self.testset = self.make_dataset(self.url_test, '__key__')
+        self.devset = self.make_eval_dataset(self.url_dev)
+        self.testset = self.make_eval_dataset(self.url_test)
 
     def train_dataloader(self):
-        return torch.utils.data.DataLoader(self.trainset, num_workers=4, batch_size=None)
+        return StreamLoader(
+            self.trainset,
+            on_iter=self.start_epoch,
+            reused=self.zero_copy and self.speakers_per_batch is None,
+            num_workers=self.num_workers,
+            batch_size=None,
+            pin_memory=self.pin_memory,
+            # only accepted with workers
+            **({'prefetch_factor': self.prefetch_factor} if self.num_workers > 0 else {}),
+        )
 
     def val_dataloader(self):
-        return torch.utils.data.DataLoader(self.devset, num_workers=4, batch_size=None)
+        return torch.utils.data.DataLoader(self.devset, num_workers=self.num_workers, batch_size=None)
 
     def test_dataloader(self):
-        return torch.utils.data.DataLoader(self.testset, num_workers=4, batch_size=None)
+        return torch.utils.data.DataLoader(self.testset, num_workers=self.num_workers, batch_size=None)
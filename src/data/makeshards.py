@@ -1,15 +1,33 @@
+import argparse
+import io
 import os
 import glob
+import json
+import random
+import tarfile
+import functools
+import multiprocessing
 
+import numpy as np
+import soundfile
 import torch
-import torchaudio
-import webdataset
 
 
 def basename(path):
     return os.path.splitext(os.path.basename(path))[0]
 
 
+def read_transcript(path):
+    transcript = {}
+
+    with open(path) as f:
+        for line in f:
+            name, text = line.strip().split(" ", 1)
+            transcript[name] = text
+
+    return transcript
+
+
 class LibriSpeech(torch.utils.data.Dataset):
     def __init__(self, path: str, split: str = 'train') -> None:
         self.fn = []
@@ -18,11 +36,14 @@ class LibriSpeech(torch.utils.data.Dataset):
         self.chap = []
         self.uttr = []
 
-        urls = [url for url in os.listdir(path) if url.startswith(split)]
+        # sorted, so that the order does not depend on the file system
+        urls = sorted(url for url in os.listdir(path) if url.startswith(split))
 
         for url in urls:
             # path/split/speaker id/chapter id/filename
-            files = glob.glob(os.path.join(path, url, '*', '*', '*.flac'))
+            files = sorted(glob.glob(os.path.join(path, url, '*', '*', '*.flac')))
+
+            transcripts = {}
 
             for file in files:
                 basename, _ = os.path.splitext(os.path.basename(file))
@@ -35,16 +56,15 @@ class LibriSpeech(torch.utils.data.Dataset):
 
                 text = os.path.join(path, url, spk, chap, spk + '-' + chap + '.trans.txt')
 
-                with open(text) as ft:
-                    for line in ft:
-                        name, text = line.strip().split(" ", 1)
-                        if basename == name:
-                            break
-                    else:
-                        # Translation not found
-                        raise FileNotFoundError("Translation not found for " + basename)
+                # each chapter transcript is parsed once
+                if text not in transcripts:
+                    transcripts[text] = read_transcript(text)
+
+                if basename not in transcripts[text]:
+                    # Translation not found
+                    raise FileNotFoundError("Translation not found for " + basename)
 
-                self.text.append(text)
+                self.text.append(transcripts[text][basename])
 
         unique_speakers = sorted(set(self.spk))
         num_speakers = len(unique_speakers)
@@ -66,36 +86,176 @@ class LibriSpeech(torch.utils.data.Dataset):
         )
 
 
-def make_dataset(root, folder_in_archive='LibriSpeech', split='train', maxsize=2 ** 30, maxcount=2 ** 20):
-    urls = [url for url in os.listdir(os.path.join(root, folder_in_archive)) if url.startswith(split)]
+@functools.lru_cache()
+def logmel_frontend():
+    from model.frontend import LogMelFrontend
 
-    dataset = LibriSpeech(os.path.join(root, folder_in_archive), split)
-    sampler = torch.utils.data.RandomSampler(dataset)
+    # stored without mean normalization, which is applied after cropping
+    return LogMelFrontend(mean_norm=False)
 
-    dst = os.path.join(root, 'webdataset', 'shards', f'librespeech-{split}-%06d.tar')
 
-    with webdataset.ShardWriter(dst, maxsize=maxsize, maxcount=maxcount) as sink:
-        for i in sampler:
-            # dont need raw waveform
-            fn, text, spk, chap, utter = dataset[i]
+def encode(fn, fmt='flac'):
+    if fmt == 'flac':
+        with open(fn, 'rb') as f:
+            return "waveform.flac", f.read()
+
+    if fmt == 'pcm16':
+        # raw little-endian int16 samples, decoded once here instead of every epoch
+        waveform, _ = soundfile.read(fn, dtype='int16')
+        return "waveform.pcm16", waveform.astype('<i2').tobytes()
+
+    if fmt == 'logmel':
+        # needs `src` on the path, e.g. PYTHONPATH=src
+        from model.frontend import encode_features
+
+        frontend = logmel_frontend()
+        waveform, _ = soundfile.read(fn, dtype='float32')
+
+        with torch.no_grad():
+            features = frontend(torch.from_numpy(waveform).unsqueeze(0))[0]
+
+        return "logmel.npy", encode_features(features)
+
+    raise ValueError(f'Unknown format {fmt}')
+
+
+def index_path(path):
+    return os.path.splitext(path)[0] + '.index.json'
+
+
+def duration(extension, data):
+    if extension == 'waveform.flac':
+        return soundfile.info(io.BytesIO(data)).duration
+    if extension == 'waveform.pcm16':
+        return len(data) / 2 / 16000
+    if extension == 'logmel.npy':
+        # 10ms hop
+        return np.load(io.BytesIO(data)).shape[1] * 0.01
+    raise ValueError(f'Unknown extension {extension}')
+
+
+def index_shard(path):
+    # byte offsets of every sample and of each of its members, for random access
+    samples = []
+
+    with tarfile.open(path) as tar:
+        for member in tar:
+            key, extension = member.name.split('.', 1)
+
+            if not samples or samples[-1]['key'] != key:
+                samples.append({'key': key, 'offset': member.offset, 'members': {}})
+
+            sample = samples[-1]
+            sample['members'][extension] = [member.offset_data, member.size]
+            sample['size'] = member.offset_data + -(-member.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE - sample['offset']
+
+            data = tar.extractfile(member).read()
+
+            if extension == 'speaker.id':
+                sample['speaker'] = int(data)
+            elif extension in ['waveform.flac', 'waveform.pcm16', 'logmel.npy']:
+                sample['duration'] = duration(extension, data)
+
+    return samples
 
-            with open(fn, 'rb') as f:
-                data = f.read()
+
+def write_index(path, dst=None):
+    # also usable on shards written by `webdataset.ShardWriter`
+    dst = dst or index_path(path)
+
+    with open(dst + '.tmp', 'w') as f:
+        json.dump({'shard': os.path.basename(dst)[:-len('.index.json')] + '.tar', 'samples': index_shard(path)}, f)
+
+    os.replace(dst + '.tmp', dst)
+
+
+def add_sample(sink, key, sample):
+    # same layout as `webdataset.TarWriter`, with fixed metadata so that output is reproducible
+    for k in sorted(sample.keys()):
+        info = tarfile.TarInfo(key + '.' + k)
+        info.size = len(sample[k])
+        info.mtime = 0
+        info.mode = 0o444
+        info.uname = 'bigdata'
+        info.gname = 'bigdata'
+        sink.addfile(info, io.BytesIO(sample[k]))
+
+
+def write_shard(args):
+    # one shard per call, so that workers never share a writer
+    dst, samples, fmt = args
+
+    # deterministic output, and no oversubscription from intra-op threads
+    torch.set_num_threads(1)
+
+    tmp = dst + '.tmp'
+
+    with tarfile.open(tmp, 'w', format=tarfile.USTAR_FORMAT) as sink:
+        for fn, text, spk in samples:
+            extension, data = encode(fn, fmt)
 
             sample = {
-                "__key__": f'{basename(fn)}',
-                "waveform.flac": data,
-                "text.txt": text,
-                "speaker.id": spk,
+                extension: data,
+                "text.txt": text.encode('utf-8'),
+                "speaker.id": str(spk).encode('utf-8'),
             }
 
-            sink.write(sample)
+            add_sample(sink, basename(fn), sample)
+
+    write_index(tmp, index_path(dst))
+    os.replace(tmp, dst)
+
+    return dst
+
+
+def make_dataset(root, folder_in_archive='LibriSpeech', split='train', maxcount=4800, fmt='flac', seed=1234, processes=None):
+    dataset = LibriSpeech(os.path.join(root, folder_in_archive), split)
+
+    # global shuffle, fixed by `seed`
+    order = list(range(len(dataset)))
+    random.Random(seed).shuffle(order)
+
+    name = f'librespeech-{split}' if fmt == 'flac' else f'librespeech-{split}-{fmt}'
+    dst = os.path.join(root, 'webdataset', 'shards', name + '-%06d.tar')
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+
+    shards = []
+
+    for shard, start in enumerate(range(0, len(order), maxcount)):
+        samples = []
+
+        for i in order[start:start + maxcount]:
+            fn, text, spk, chap, utter = dataset[i]
+            samples.append((fn, text, spk))
+
+        shards.append((dst % shard, samples, fmt))
+
+    with multiprocessing.Pool(processes) as pool:
+        for path in pool.imap_unordered(write_shard, shards):
+            print(f'# writing {path}')
 
 
 def main():
-    make_dataset('data/materials', split='train')
-    make_dataset('data/materials', split='dev')
-    make_dataset('data/materials', split='test')
+    parser = argparse.ArgumentParser(description='Write LibriSpeech train, dev and test shards.')
+    parser.add_argument('--root', default='data/materials')
+    parser.add_argument(
+        '--formats', nargs='+', choices=['flac', 'pcm16', 'logmel'], default=['flac'],
+        help='logmel needs `src` on the path, e.g. PYTHONPATH=src'
+    )
+    args = parser.parse_args()
+
+    if 'logmel' in args.formats:
+        # fail before any shard is written rather than after the other formats
+        try:
+            logmel_frontend()
+        except ImportError as e:
+            parser.error(f'logmel shards need `src` on the path, e.g. PYTHONPATH=src ({e})')
+
+    # 59 train shards, a single dev and test shard
+    for fmt in args.formats:
+        make_dataset(args.root, split='train', fmt=fmt)
+        make_dataset(args.root, split='dev', maxcount=2 ** 20, fmt=fmt)
+        make_dataset(args.root, split='test', maxcount=2 ** 20, fmt=fmt)
 
 
 if __name__ == '__main__':
@@ -1,9 +1,17 @@
 import os
 import glob
+import random
+import tarfile
+import multiprocessing
 
 import torch
-import torchaudio
-import webdataset
+
+from makeshards import add_sample, read_transcript
+
+
+def read(fn):
+    with open(fn, 'rb') as f:
+        return f.read()
 
 
 class LibriSpeech(torch.utils.data.Dataset):
@@ -14,11 +22,14 @@ class LibriSpeech(torch.utils.data.Dataset):
         self.chap = []
         self.uttr = []
 
-        urls = [url for url in os.listdir(path) if url.startswith(split)]
+        # sorted, so that the order does not depend on the file system
+        urls = sorted(url for url in os.listdir(path) if url.startswith(split))
 
         for url in urls:
             # path/split/speaker id/chapter id/filename
-            files = glob.glob(os.path.join(path, url, '*', '*', '*.flac'))
+            files = sorted(glob.glob(os.path.join(path, url, '*', '*', '*.flac')))
+
+            transcripts = {}
 
             for file in files:
                 basename, _ = os.path.splitext(os.path.basename(file))
@@ -31,16 +42,15 @@ class LibriSpeech(torch.utils.data.Dataset):
 
                 text = os.path.join(path, url, spk, chap, spk + '-' + chap + '.trans.txt')
 
-                with open(text) as ft:
-                    for line in ft:
-                        name, text = line.strip().split(" ", 1)
-                        if basename == name:
-                            break
-                    else:
-                        # Translation not found
-                        raise FileNotFoundError("Translation not found for " + basename)
+                # each chapter transcript is parsed once
+                if text not in transcripts:
+                    transcripts[text] = read_transcript(text)
 
-                self.text.append(text)
+                if basename not in transcripts[text]:
+                    # Translation not found
+                    raise FileNotFoundError("Translation not found for " + basename)
+
+                self.text.append(transcripts[text][basename])
 
     def __len__(self):
         return len(self.fn)
@@ -55,30 +65,29 @@ class LibriSpeech(torch.utils.data.Dataset):
         )
 
 
-def make_dataset(root, folder_in_archive='LibriSpeech', split='train'):
-    urls = [url for url in os.listdir(os.path.join(root, folder_in_archive)) if url.startswith(split)]
-
+def make_dataset(root, folder_in_archive='LibriSpeech', split='train', seed=1234, processes=None):
     dataset = LibriSpeech(os.path.join(root, folder_in_archive), split)
-    sampler = torch.utils.data.RandomSampler(dataset)
+
+    # global shuffle, fixed by `seed`
+    order = list(range(len(dataset)))
+    random.Random(seed).shuffle(order)
 
     dst = os.path.join(root, 'webdataset', 'tar', f'librespeech-{split}.tar')
 
-    with webdataset.TarWriter(dst) as sink:
-        for i in sampler:
-            # dont need raw waveform
-            fn, text, spk, chap, utter = dataset[i]
+    samples = [dataset[i] for i in order]
 
-            with open(fn, 'rb') as f:
-                data = f.read()
+    # files are read in parallel and written in order by a single writer
+    with multiprocessing.Pool(processes) as pool, tarfile.open(dst, 'w', format=tarfile.USTAR_FORMAT) as sink:
+        files = pool.imap(read, [fn for fn, *_ in samples], chunksize=64)
 
+        for (fn, text, spk, chap, utter), data in zip(samples, files):
             sample = {
-                "__key__": f'{spk}-{chap}-{utter}',
                 "waveform.flac": data,
-                "text.txt": text,
-                "speaker.id": spk,
+                "text.txt": text.encode('utf-8'),
+                "speaker.id": str(spk).encode('utf-8'),
             }
 
-            sink.write(sample)
+            add_sample(sink, f'{spk}-{chap}-{utter}', sample)
 
 
 def main():
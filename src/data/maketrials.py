@@ -1,8 +1,11 @@
-from gc import collect
+import argparse
 import os
 import glob
 import random
 import itertools
+import struct
+
+import numpy as np
 
 random.seed(1234)
 
@@ -14,11 +17,12 @@ def basename(path):
 def traverse(root, split='dev'):
     spk_to_files = {}
 
-    for spk in os.listdir(os.path.join(root, split + '-clean')):
-        spk_to_files[spk] = glob.glob(os.path.join(root, split + '-clean', spk, '*', '*.flac'))
+    # sorted, so that the trials do not depend on the file system
+    for spk in sorted(os.listdir(os.path.join(root, split + '-clean'))):
+        spk_to_files[spk] = sorted(glob.glob(os.path.join(root, split + '-clean', spk, '*', '*.flac')))
 
-    for spk in os.listdir(os.path.join(root, split + '-other')):
-        spk_to_files[spk] = glob.glob(os.path.join(root, split + '-other', spk, '*', '*.flac'))
+    for spk in sorted(os.listdir(os.path.join(root, split + '-other'))):
+        spk_to_files[spk] = sorted(glob.glob(os.path.join(root, split + '-other', spk, '*', '*.flac')))
 
     return spk_to_files
 
@@ -53,7 +57,46 @@ def write_trials(positive_pairs, negative_pairs, output):
                 f.write(f'0 {basename(enrollment)} {basename(test)}\n')
 
 
+def compile_trials(src, dst):
+    # read by `misc.eer.load_trials`
+    labels = []
+    enrollments = []
+    tests = []
+
+    with open(src) as f:
+        for line in f:
+            label, enrollment, test = line.rstrip().split(' ')
+            labels.append(int(label))
+            enrollments.append(enrollment)
+            tests.append(test)
+
+    keys = sorted(set(enrollments) | set(tests))
+    index = {key: i for i, key in enumerate(keys)}
+
+    vocab = '\n'.join(keys).encode('utf-8')
+    padding = -len(vocab) % 8
+
+    with open(dst, 'wb') as f:
+        f.write(struct.pack('<8sqqq', b'SVTRIAL1', len(keys), len(labels), len(vocab)))
+        f.write(vocab + b'\0' * padding)
+        f.write(np.array([index[k] for k in enrollments], dtype=np.int32).tobytes())
+        f.write(np.array([index[k] for k in tests], dtype=np.int32).tobytes())
+        f.write(np.array(labels, dtype=np.int8).tobytes())
+
+
 def main():
+    parser = argparse.ArgumentParser(description='Make dev and test trial lists and compile them.')
+    parser.add_argument(
+        '--compile', nargs='+', metavar='TRIALS',
+        help='only compile these existing trial lists, each into a .bin file next to it'
+    )
+    args = parser.parse_args()
+
+    if args.compile is not None:
+        for path in args.compile:
+            compile_trials(path, os.path.splitext(path)[0] + '.bin')
+        return
+
     root = 'data/materials/LibriSpeech/'
     dev_trials = 'data/materials/dev-trials.txt'
     test_trials = 'data/materials/test-trials.txt'
@@ -67,6 +110,9 @@ def main():
     write_trials(dev_positive_pairs, dev_negative_pairs, dev_trials)
     write_trials(test_positive_pairs, test_negative_pairs, test_trials)
 
+    compile_trials(dev_trials, os.path.splitext(dev_trials)[0] + '.bin')
+    compile_trials(test_trials, os.path.splitext(test_trials)[0] + '.bin')
+
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,112 @@
+import io
+import random
+import time
+
+import numpy as np
+import soundfile
+import torch
+
+from multiprocessing.reduction import ForkingPickler
+
+from librispeech import FORMATS, collate, cropped_batches
+
+
+def make_samples(num_samples, fmt, num_speakers=40, seed=1234):
+    # noise utterances of 1-16s as raw sample bytes, so that the benchmark runs offline
+    rng = np.random.default_rng(seed)
+    samples = []
+
+    for _ in range(num_samples):
+        waveform = rng.uniform(-0.5, 0.5, int(rng.integers(16000, 16 * 16000))).astype(np.float32)
+
+        if fmt == 'flac':
+            f = io.BytesIO()
+            soundfile.write(f, waveform, 16000, format='FLAC', subtype='PCM_16')
+            b = f.getvalue()
+        else:
+            b = (waveform * 32768).astype('<i2').tobytes()
+
+        samples.append((b, str(rng.integers(num_speakers)).encode('utf-8'), {}))
+
+    return samples
+
+
+def stacked_batches(data, batch_size, fmt='flac'):
+    # the default pipeline: a new tensor per crop, stacked into a new batch
+    _, handler, _ = FORMATS[fmt]
+    batch = []
+
+    for b, label, _ in data:
+        batch.append((handler(b), int(label)))
+
+        if len(batch) == batch_size:
+            yield collate(batch)
+            batch = []
+
+    if batch:
+        yield collate(batch)
+
+
+def measure(batches, pin):
+    # Each batch is pickled as for a dataloader worker queue, which moves it into shared
+    # memory unless it is there already, then optionally copied into pinned memory.
+    allocations = 0
+    allocated = 0
+    shared = 0
+    count = 0
+
+    start_time = time.perf_counter()
+
+    with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU], profile_memory=True) as prof:
+        for x, labels, *_ in batches:
+            if not x.is_shared():
+                shared += x.numel() * x.element_size()
+
+            ForkingPickler.dumps((x, labels))
+
+            if pin:
+                x.pin_memory()
+
+            count += 1
+
+    end_time = time.perf_counter()
+
+    # memory of an operator is attributed to it, the rest shows up as '[memory]' events
+    for event in prof.events():
+        if event.self_cpu_memory_usage > 0:
+            allocations += 1
+            allocated += event.self_cpu_memory_usage
+
+    return {
+        'ms': (end_time - start_time) * 1000 / count,
+        'allocations': allocations / count,
+        'allocated': allocated / count / 2 ** 20,
+        'shared': shared / count / 2 ** 20,
+    }
+
+
+def main():
+    batch_size = 128
+    num_samples = 1024
+    pin = torch.cuda.is_available()
+
+    for fmt in ['flac', 'pcm16']:
+        samples = make_samples(num_samples, fmt)
+
+        random.seed(1234)
+        stacked = measure(stacked_batches(samples, batch_size, fmt), pin)
+
+        random.seed(1234)
+        buffered = measure(cropped_batches(samples, batch_size, fmt, share=True), pin)
+
+        print(f'{fmt}, {batch_size} x {int(1.5 * 16000)} per batch{", pinned" if pin else ""}:')
+
+        for name, result in [('stack', stacked), ('cropped_batches', buffered)]:
+            print(
+                f'  {name:16s} {result["ms"]:.1f}ms, {result["allocations"]:.0f} tensor allocations, '
+                f'{result["allocated"]:.1f}MiB allocated, {result["shared"]:.1f}MiB copied into shared memory'
+            )
+
+
+if __name__ == '__main__':
+    main()
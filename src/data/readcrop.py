@@ -0,0 +1,43 @@
+import random
+import time
+
+import webdataset
+
+from librispeech import flac_crop_handler, flac_handler_soundfile, random_crop
+
+
+def decode_then_crop(b):
+    return random_crop((flac_handler_soundfile(b), None))[0]
+
+
+def measure(handler, blobs):
+    # CPU time of this process only, so dataloader noise does not count
+    start_time = time.process_time()
+
+    for b in blobs:
+        handler(b)
+
+    end_time = time.process_time()
+
+    return (end_time - start_time) / len(blobs)
+
+
+def main():
+    url = "data/materials/webdataset/shards/librespeech-train-000000.tar"
+    limit = 1000
+
+    dataset = webdataset.WebDataset(url).to_tuple("waveform.flac")
+    blobs = [b for _, (b,) in zip(range(limit), dataset)]
+
+    random.seed(1234)
+    full = measure(decode_then_crop, blobs)
+
+    random.seed(1234)
+    window = measure(flac_crop_handler, blobs)
+
+    print(f'decode + random_crop: {full * 1000:.2f}ms CPU per sample')
+    print(f'flac_crop_handler:    {window * 1000:.2f}ms CPU per sample ({full / window:.1f}x, {(full - window) * 1000:.2f}ms saved)')
+
+
+if __name__ == '__main__':
+    main()
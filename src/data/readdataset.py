@@ -1,61 +1,244 @@
-import io
+import argparse
+import glob
+import json
+import multiprocessing
+import os
 import random
+import resource
+import tempfile
 import time
 
+import numpy as np
 import soundfile
-
 import torch
-import torchaudio
-import webdataset
 
-from tqdm import tqdm
+from librispeech import FORMATS, LibriSpeech, collate, random_crop, read_shard
+from makeshards import write_shard
 
 
-def flac_handler_soundfile(b):
-    return torch.from_numpy(soundfile.read(io.BytesIO(b))[0])
+def make_synthetic_shards(root, fmt='flac', num_shards=4, samples_per_shard=64, num_speakers=40, seed=1234):
+    # noise utterances of 2-16s written through `makeshards`, for benchmarks without LibriSpeech.
+    # The logmel format needs `src` on the path, e.g. PYTHONPATH=src
+    rng = np.random.default_rng(seed)
 
+    audio = os.path.join(root, 'audio')
+    os.makedirs(audio, exist_ok=True)
 
-def transform(data, crop_length=int(1.5 * 16000)):
-    waveform, spk = data
+    samples = []
 
-    length = waveform.size(0)
+    for i in range(num_shards * samples_per_shard):
+        fn = os.path.join(audio, f'synthetic-{i:06d}.flac')
 
-    if length < crop_length:
-        result = torch.nn.functional.pad(waveform, (0, crop_length - length))
-    elif length == crop_length:
-        result = waveform
-    else:
-        start = random.randint(0, len(waveform) - crop_length - 1)
-        result = waveform[start:start+crop_length]
+        if not os.path.exists(fn):
+            length = int(rng.integers(2 * 16000, 16 * 16000))
+            soundfile.write(fn, rng.uniform(-0.5, 0.5, length).astype(np.float32), 16000, subtype='PCM_16')
 
-    return result, spk
+        samples.append((fn, '', int(rng.integers(num_speakers))))
 
+    dst = os.path.join(root, f'synthetic-{fmt}-%06d.tar')
+    shards = [
+        (dst % shard, samples[start:start + samples_per_shard], fmt)
+        for shard, start in enumerate(range(0, len(samples), samples_per_shard))
+    ]
 
-def main():
-    url = "data/materials/webdataset/shards/librespeech-train-{000000..000058}.tar"
-    # url = "data/webdataset/tar/librespeech-train.tar"
-    # url = "gs://librispeech-webdataset/librespeech-train-{000000..000058}.tar"
+    # in other processes, `write_shard` limits the number of threads
+    with multiprocessing.Pool() as pool:
+        return pool.map(write_shard, shards)
+
+
+def usage(who=resource.RUSAGE_SELF):
+    # CPU seconds and peak resident memory in MiB (maximum over all children for RUSAGE_CHILDREN)
+    r = resource.getrusage(who)
+    return r.ru_utime + r.ru_stime, r.ru_maxrss / 1024
+
+
+def measure(stage, fn, items, count=None):
+    cpu_start, _ = usage()
+    start_time = time.perf_counter()
+
+    results = [fn(item) for item in items]
+
+    end_time = time.perf_counter()
+    cpu_end, max_rss = usage()
+
+    count = len(items) if count is None else count
+    seconds = end_time - start_time
+
+    report = {
+        'stage': stage,
+        'samples': count,
+        'seconds': seconds,
+        'samples_per_s': count / seconds,
+        'cpu_ms_per_sample': (cpu_end - cpu_start) * 1000 / count,
+        'max_rss_mb': max_rss,
+    }
+
+    return results, report
+
+
+def read_stage(urls, key):
+    # raw sample bytes in shard order, the tar/index read alone
+    def read(url):
+        return [(sample[key], int(sample['speaker.id'])) for sample in read_shard(url)]
+
+    shards, report = measure('read', read, urls)
+    samples = [sample for shard in shards for sample in shard]
+
+    report['samples'] = len(samples)
+    report['samples_per_s'] = len(samples) / report['seconds']
+    report['cpu_ms_per_sample'] *= len(urls) / len(samples)
+    report['mb_per_s'] = sum(len(b) for b, _ in samples) / 2 ** 20 / report['seconds']
+
+    return samples, report
+
+
+def sync(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def stages(urls, fmt, batch_sizes, device):
+    # every stage in this process and one after another, so each is timed alone
+    key, crop_handler, handler = FORMATS[fmt]
+    reports = []
+
+    samples, report = read_stage(urls, key)
+    reports.append(report)
 
-    dataset = webdataset.WebDataset(url, shardshuffle=True) \
-        .shuffle(1000) \
-        .decode(webdataset.handle_extension("flac", flac_handler_soundfile)) \
-        .to_tuple("waveform.flac", "speaker.id") \
-        .map(transform) \
-        .batched(16)
+    blobs = [b for b, _ in samples]
 
-    dataloader = torch.utils.data.DataLoader(dataset, num_workers=4, batch_size=None)
+    decoded, report = measure('decode', handler, blobs)
+    reports.append(report)
 
-    start_time = time.time()
+    if fmt != 'logmel':
+        # waveforms only, features are cropped along frames by their handler
+        _, report = measure('crop', lambda x: random_crop((x, None)), decoded)
+        reports.append(report)
+
+    # decoding and cropping in one step, as in training
+    cropped, report = measure('decode_crop', crop_handler, blobs)
+    reports.append(report)
+
+    del decoded
+
+    labels = [spk for _, spk in samples]
+
+    for batch_size in batch_sizes:
+        chunks = [
+            list(zip(cropped[start:start + batch_size], labels[start:start + batch_size]))
+            for start in range(0, len(cropped), batch_size)
+        ]
+
+        batches, report = measure('collate', collate, chunks, len(cropped))
+        reports.append(dict(report, batch_size=batch_size))
+
+        if device.type != 'cpu':
+            def transfer(batch):
+                x = batch[0].to(device)
+                sync(device)
+                return x
+
+            _, report = measure('h2d', transfer, batches, len(cropped))
+            report['mb_per_s'] = sum(x.numel() * x.element_size() for x, _ in batches) / 2 ** 20 / report['seconds']
+            reports.append(dict(report, batch_size=batch_size))
+
+    return [dict(report, fmt=fmt) for report in reports]
+
+
+def loader(urls, fmt, num_workers, batch_size, device, zero_copy=False, pin_memory=False):
+    # the training dataloader end to end, with the host-to-device copy of every batch
+    datamodule = LibriSpeech(urls, urls, urls, batch_size=batch_size, fmt=fmt, zero_copy=zero_copy, pin_memory=pin_memory)
+    datamodule.num_workers = num_workers
+    datamodule.trainset = datamodule.make_dataset(urls)
+
+    dataloader = datamodule.train_dataloader()
+
+    cpu_start, _ = usage()
+    children_start, _ = usage(resource.RUSAGE_CHILDREN)
+    start_time = time.perf_counter()
 
     count = 0
 
-    for i, data in tqdm(enumerate(dataloader)):
-        waveform, speaker_id = data
-        count += waveform.size(0)
+    for batch in dataloader:
+        x, labels = datamodule.on_before_batch_transfer(batch, 0)
+        x.to(device, non_blocking=pin_memory)
+        count += x.size(0)
+
+    sync(device)
+
+    end_time = time.perf_counter()
+
+    # workers are joined at the end of the epoch, so their usage is counted by now
+    cpu_end, max_rss = usage()
+    children_end, children_max_rss = usage(resource.RUSAGE_CHILDREN)
 
-    end_time = time.time()
+    seconds = end_time - start_time
 
-    print(f'Read {count} files in {end_time - start_time}s from {url}.')
+    return {
+        'stage': 'loader',
+        'fmt': fmt,
+        'num_workers': num_workers,
+        'batch_size': batch_size,
+        'zero_copy': zero_copy,
+        'pin_memory': pin_memory,
+        'samples': count,
+        'seconds': seconds,
+        'samples_per_s': count / seconds,
+        'main_cpu_s': cpu_end - cpu_start,
+        'cpu_s_per_worker': (children_end - children_start) / num_workers if num_workers else None,
+        'max_rss_mb': max_rss,
+        'worker_max_rss_mb': children_max_rss if num_workers else None,
+    }
+
+
+def size_on_disk(urls):
+    return sum(os.path.getsize(url) for url in urls)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark each stage of the training data pipeline.')
+    parser.add_argument('--formats', nargs='+', default=['flac', 'pcm16', 'logmel'], choices=list(FORMATS))
+    parser.add_argument('--shards', default='data/materials/webdataset/shards',
+                        help='directory of librespeech-train shards')
+    parser.add_argument('--synthetic', action='store_true', help='generate small noise shards instead')
+    parser.add_argument('--num-shards', type=int, default=4)
+    parser.add_argument('--samples-per-shard', type=int, default=64)
+    parser.add_argument('--num-workers', type=int, nargs='+', default=[0, 2, 4])
+    parser.add_argument('--batch-size', type=int, nargs='+', default=[16, 128])
+    parser.add_argument('--zero-copy', action='store_true', help='crop into shared memory batch buffers')
+    parser.add_argument('--pin-memory', action='store_true')
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--output', help='also write the JSON report to this file')
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    report = {'config': vars(args), 'formats': {}, 'stages': [], 'loader': []}
+
+    with tempfile.TemporaryDirectory() as root:
+        for fmt in args.formats:
+            if args.synthetic:
+                urls = make_synthetic_shards(root, fmt, args.num_shards, args.samples_per_shard)
+            else:
+                name = 'librespeech-train' if fmt == 'flac' else f'librespeech-train-{fmt}'
+                urls = sorted(glob.glob(os.path.join(args.shards, f'{name}-[0-9]*.tar')))[:args.num_shards]
+
+            report['formats'][fmt] = {'shards': len(urls), 'bytes_on_disk': size_on_disk(urls)}
+
+            random.seed(1234)
+            report['stages'] += stages(urls, fmt, args.batch_size, device)
+
+            for num_workers in args.num_workers:
+                for batch_size in args.batch_size:
+                    report['loader'].append(loader(
+                        urls, fmt, num_workers, batch_size, device, args.zero_copy, args.pin_memory
+                    ))
+
+    text = json.dumps(report, indent=2)
+    print(text)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
 
 
 if __name__ == "__main__":
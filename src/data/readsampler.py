@@ -0,0 +1,57 @@
+import random
+import time
+
+import torch
+
+from librispeech import collate, speaker_batches
+
+
+def stream(num_samples, num_speakers=2338, crop_length=int(1.5 * 16000)):
+    # decoded crops from randomly ordered shards
+    x = torch.zeros(crop_length)
+
+    for _ in range(num_samples):
+        yield x, random.randrange(num_speakers)
+
+
+def batched(data, batch_size):
+    batch = []
+
+    for sample in data:
+        batch.append(sample)
+
+        if len(batch) == batch_size:
+            yield collate(batch)
+            batch = []
+
+    if batch:
+        yield collate(batch)
+
+
+def measure(batches):
+    start_time = time.time()
+
+    count = 0
+    speakers = []
+
+    for x, spk in batches:
+        count += x.size(0)
+        speakers.append(len(torch.unique(spk)))
+
+    end_time = time.time()
+
+    return count / (end_time - start_time), sum(speakers) / len(speakers)
+
+
+def main():
+    num_samples = 100_000
+
+    speed, speakers = measure(batched(stream(num_samples), 128))
+    print(f'batched:         {speed:.0f} samples/s, {speakers:.1f} speakers per batch')
+
+    speed, speakers = measure(speaker_batches(stream(num_samples), speakers=32, utterances=4))
+    print(f'speaker_batches: {speed:.0f} samples/s, {speakers:.1f} speakers per batch')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+import argparse
+import collections
+import concurrent.futures
+import glob
+import os
+import time
+
+import numpy as np
+import soundfile
+import torch
+
+from data.librispeech import LibriSpeech, bucket_by_length
+from misc.store import EmbeddingStore, checkpoint_hash
+from model.export import export
+from model.svmodel import SVSystem
+from train import make_modules
+
+
+# upper bounds in seconds of the utterance lengths latency is reported for
+LENGTHS = [2, 4, 8, 16, 32, float('inf')]
+
+
+def load(path, quantize=False):
+    # a Lightning checkpoint exported for inference, or an already exported TorchScript file
+    if path.endswith('.pt'):
+        return torch.jit.load(path)
+
+    fbank, embedding, loss = make_modules()
+    model = SVSystem.load_from_checkpoint(path, fbank=fbank, embedding=embedding, loss=loss)
+
+    return export(model.fbank, model.embedding, quantize)
+
+
+def read_directory(root):
+    # (waveform, key) of every audio file under `root`, keyed like the shards by file name
+    paths = sorted(
+        path for extension in ['flac', 'wav']
+        for path in glob.glob(os.path.join(root, '**', f'*.{extension}'), recursive=True)
+    )
+
+    for path in paths:
+        waveform, _ = soundfile.read(path, dtype='float32')
+        yield torch.from_numpy(waveform), os.path.splitext(os.path.basename(path))[0]
+
+
+def batches(inputs, batch_size, num_workers=4):
+    # (padded waveforms, lengths, keys) from directories of audio files or shard URLs
+    for source in inputs:
+        if os.path.isdir(source):
+            yield from bucket_by_length(read_directory(source), batch_size)
+        else:
+            datamodule = LibriSpeech(source, source, source, batch_size=batch_size, eval_batch_size=batch_size)
+            yield from torch.utils.data.DataLoader(
+                datamodule.make_eval_dataset(source), num_workers=num_workers, batch_size=None
+            )
+
+
+def bounded_map(pool, fn, items, depth):
+    # `pool.map` in order, with at most `depth` items read ahead instead of all of them
+    pending = collections.deque()
+
+    for item in items:
+        pending.append(pool.submit(fn, item))
+
+        if len(pending) >= depth:
+            yield pending.popleft().result()
+
+    while pending:
+        yield pending.popleft().result()
+
+
+def run(module, batches, workers=2):
+    # batches run concurrently by `workers` threads, each batch timed on its own
+    @torch.no_grad()
+    def work(batch):
+        x, lengths, keys = batch
+
+        start_time = time.perf_counter()
+        embeddings = module(x, lengths)
+        end_time = time.perf_counter()
+
+        return keys, lengths, embeddings, end_time - start_time
+
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        yield from bounded_map(pool, work, batches, 2 * workers)
+
+
+def report(latencies, count, seconds):
+    # embeddings/s overall, and latency percentiles per utterance length
+    print(f'{count} embeddings in {seconds:.1f}s ({count / seconds:.1f} embeddings/s)')
+
+    low = 0
+
+    for high in LENGTHS:
+        values = [latency for length, latency in latencies if low <= length < high]
+
+        if values:
+            p50, p99 = np.percentile(values, [50, 99]) * 1000
+            print(f'  {low}s-{high}s: {len(values)} utterances, p50 {p50:.1f}ms, p99 {p99:.1f}ms')
+
+        low = high
+
+
+def synthetic(batch_size, repeat=20):
+    # noise utterances of fixed lengths, so that latency does not depend on a data set
+    for seconds in [1.5, 3, 6, 12, 24]:
+        for _ in range(repeat):
+            x = torch.randn(batch_size, int(seconds * 16000))
+            yield x, torch.full((batch_size,), x.size(-1)), [None] * batch_size
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Extract embeddings with an exported inference model.')
+    parser.add_argument('checkpoint', help='Lightning checkpoint, or a TorchScript file written by --save')
+    parser.add_argument('inputs', nargs='*', help='directories of audio files or shard URLs')
+    parser.add_argument('--store', default='data/artifacts/embeddings')
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--workers', type=int, default=2, help='batches run concurrently')
+    parser.add_argument('--threads', type=int, default=None, help='intra-op threads, shared by the workers')
+    parser.add_argument('--quantize', action='store_true', help='dynamic int8 linear layers')
+    parser.add_argument('--save', help='write the exported model to this TorchScript file')
+    parser.add_argument('--benchmark', action='store_true', help='time synthetic utterances instead')
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    module = load(args.checkpoint, args.quantize)
+
+    if args.save is not None:
+        torch.jit.save(module, args.save)
+
+    if args.benchmark:
+        source = synthetic(args.batch_size)
+        store = None
+    else:
+        source = batches(args.inputs, args.batch_size)
+
+        # quantized embeddings differ from the float ones, so they are stored apart
+        checkpoint = checkpoint_hash(args.checkpoint) + ('-int8' if args.quantize else '')
+        store = EmbeddingStore(args.store, checkpoint)
+
+    latencies = []
+    count = 0
+
+    start_time = time.perf_counter()
+
+    for keys, lengths, embeddings, seconds in run(module, source, args.workers):
+        if store is not None:
+            todo = [i for i, key in enumerate(keys) if key not in store]
+            store.append([keys[i] for i in todo], embeddings[todo])
+
+        # every utterance of a batch waits for the whole batch
+        latencies += [(int(length) / 16000, seconds) for length in lengths]
+        count += len(keys)
+
+    end_time = time.perf_counter()
+
+    report(latencies, count, end_time - start_time)
+
+
+if __name__ == '__main__':
+    main()
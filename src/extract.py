@@ -0,0 +1,55 @@
+import argparse
+
+import torch
+from tqdm import tqdm
+
+from data.librispeech import LibriSpeech
+from misc.store import EmbeddingStore, checkpoint_hash
+from model.svmodel import SVSystem
+from train import make_modules
+
+
+@torch.no_grad()
+def extract(model, dataloader, store):
+    for x, lengths, keys in tqdm(dataloader):
+        # already extracted with this checkpoint
+        todo = [i for i, key in enumerate(keys) if key not in store]
+
+        if not todo:
+            continue
+
+        emb = model(x[todo].to(model.device), lengths[todo])
+        store.append([keys[i] for i in todo], emb)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Extract embeddings into an on-disk store.')
+    parser.add_argument('checkpoint')
+    parser.add_argument('urls', nargs='+')
+    parser.add_argument('--store', default='data/artifacts/embeddings')
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--dtype', default='float16', choices=['float16', 'float32'])
+    args = parser.parse_args()
+
+    fbank, embedding, loss = make_modules()
+
+    model = SVSystem.load_from_checkpoint(args.checkpoint, fbank=fbank, embedding=embedding, loss=loss)
+    model.eval()
+
+    if torch.cuda.is_available():
+        model.cuda()
+
+    store = EmbeddingStore(args.store, checkpoint_hash(args.checkpoint), dtype=args.dtype)
+
+    for url in args.urls:
+        datamodule = LibriSpeech(url, url, url, batch_size=args.batch_size, eval_batch_size=args.batch_size)
+        dataset = datamodule.make_eval_dataset(url)
+        dataloader = torch.utils.data.DataLoader(dataset, num_workers=4, batch_size=None)
+
+        extract(model, dataloader, store)
+
+    print(f'{len(store)} embeddings in {store.path}.')
+
+
+if __name__ == '__main__':
+    main()
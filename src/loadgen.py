@@ -0,0 +1,137 @@
+import argparse
+import asyncio
+import base64
+import io
+import json
+import random
+import time
+
+import numpy as np
+import soundfile
+
+
+def make_audio(seconds, seed):
+    # a noise utterance as base64 FLAC, as sent by clients
+    rng = np.random.default_rng(seed)
+    f = io.BytesIO()
+    soundfile.write(f, rng.uniform(-0.5, 0.5, int(seconds * 16000)).astype(np.float32), 16000, format='FLAC')
+    return base64.b64encode(f.getvalue()).decode('ascii')
+
+
+class Connection:
+    # one keep-alive HTTP/1.1 connection, one request at a time
+    def __init__(self, reader, writer, host):
+        self.reader = reader
+        self.writer = writer
+        self.host = host
+
+    @classmethod
+    async def open(cls, host, port):
+        reader, writer = await asyncio.open_connection(host, port)
+        return cls(reader, writer, host)
+
+    async def request(self, method, path, request=None):
+        body = json.dumps(request).encode('utf-8') if request is not None else b''
+
+        self.writer.write(
+            f'{method} {path} HTTP/1.1\r\n'
+            f'Host: {self.host}\r\n'
+            f'Content-Type: application/json\r\n'
+            f'Content-Length: {len(body)}\r\n\r\n'.encode('latin-1') + body
+        )
+        await self.writer.drain()
+
+        status = int((await self.reader.readline()).split()[1])
+        length = 0
+
+        while True:
+            header = await self.reader.readline()
+
+            if header in [b'\r\n', b'\n', b'']:
+                break
+
+            name, value = header.decode('latin-1').split(':', 1)
+
+            if name.strip().lower() == 'content-length':
+                length = int(value)
+
+        return status, json.loads(await self.reader.readexactly(length))
+
+    def close(self):
+        self.writer.close()
+
+
+async def enroll(host, port, speakers, audio):
+    connection = await Connection.open(host, port)
+
+    for speaker in range(speakers):
+        request = {'speaker': speaker, 'audio': audio[speaker % len(audio)]}
+        status, result = await connection.request('POST', '/enroll', request)
+        assert status == 200, result
+
+    connection.close()
+
+
+async def client(host, port, speakers, audio, deadline, latencies):
+    # verification requests back to back until `deadline`
+    connection = await Connection.open(host, port)
+    rng = random.Random()
+
+    while time.perf_counter() < deadline:
+        request = {'speaker': rng.randrange(speakers), 'audio': rng.choice(audio)}
+
+        start_time = time.perf_counter()
+        status, result = await connection.request('POST', '/verify', request)
+        end_time = time.perf_counter()
+
+        assert status == 200, result
+        latencies.append(end_time - start_time)
+
+    connection.close()
+
+
+async def run(host, port, concurrency, speakers, audio, duration):
+    latencies = []
+    deadline = time.perf_counter() + duration
+
+    start_time = time.perf_counter()
+    await asyncio.gather(*[client(host, port, speakers, audio, deadline, latencies) for _ in range(concurrency)])
+    end_time = time.perf_counter()
+
+    return len(latencies) / (end_time - start_time), np.percentile(latencies, [50, 90, 99]) * 1000
+
+
+async def main_async(args):
+    audio = [make_audio(args.seconds, seed) for seed in range(8)]
+
+    await enroll(args.host, args.port, args.speakers, audio)
+
+    for concurrency in args.concurrency:
+        throughput, (p50, p90, p99) = await run(args.host, args.port, concurrency, args.speakers, audio, args.duration)
+        print(
+            f'{concurrency} concurrent clients: {throughput:.1f} requests/s, '
+            f'p50 {p50:.0f}ms, p90 {p90:.0f}ms, p99 {p99:.0f}ms'
+        )
+
+    connection = await Connection.open(args.host, args.port)
+    _, stats = await connection.request('GET', '/stats')
+    connection.close()
+
+    print(f'server: {stats}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test a running `serve.py` with verification requests.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16, 64])
+    parser.add_argument('--duration', type=float, default=10, help='seconds per concurrency level')
+    parser.add_argument('--speakers', type=int, default=100, help='speakers enrolled first')
+    parser.add_argument('--seconds', type=float, default=3, help='length of each utterance')
+    args = parser.parse_args()
+
+    asyncio.run(main_async(args))
+
+
+if __name__ == '__main__':
+    main()
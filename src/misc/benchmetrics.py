@@ -0,0 +1,66 @@
+import time
+
+import torch
+import torchmetrics
+
+from eer import StreamingMetrics, compute_eer, compute_metrics
+
+
+def compute_eer_roc(scores, labels):
+    # the previous implementation on top of `torchmetrics.functional.roc`
+    fpr, tpr, thresholds = torchmetrics.functional.roc(scores, labels, pos_label=1)
+    fnr = 1 - tpr
+
+    fnr = fnr * 100
+    fpr = fpr * 100
+
+    opt = torch.argmin(torch.abs((fnr - fpr)))
+    eer = max(fpr[opt], fnr[opt])
+
+    return eer, thresholds[opt]
+
+
+def make_scores(num_trials):
+    labels = torch.randint(2, (num_trials,))
+    # cosine-like scores, targets shifted upwards
+    scores = torch.tanh(torch.randn(num_trials) * 0.3 + labels * 0.6 - 0.2)
+    return scores, labels
+
+
+def measure(f, *args):
+    start_time = time.time()
+    result = f(*args)
+    end_time = time.time()
+    return result, end_time - start_time
+
+
+def stream(scores, labels, chunk_size=2 ** 20):
+    metrics = StreamingMetrics()
+
+    for start in range(0, len(scores), chunk_size):
+        metrics.update(scores[start:start + chunk_size], labels[start:start + chunk_size])
+
+    return metrics.compute()
+
+
+def main():
+    num_trials = 10_000_000
+    scores, labels = make_scores(num_trials)
+
+    (eer_roc, th_roc), t_roc = measure(compute_eer_roc, scores, labels)
+    print(f'torchmetrics.roc: eer {eer_roc:.4f} threshold {th_roc:.6f} in {t_roc:.3f}s')
+
+    (eer, th), t_eer = measure(compute_eer, scores, labels)
+    print(f'compute_eer:      eer {eer:.4f} threshold {th:.6f} in {t_eer:.3f}s')
+
+    metrics, t_metrics = measure(compute_metrics, scores, labels)
+    print(f'compute_metrics:  {metrics} in {t_metrics:.3f}s')
+
+    streamed, t_stream = measure(stream, scores, labels)
+    print(f'StreamingMetrics: {streamed} in {t_stream:.3f}s')
+
+    assert abs(eer - float(eer_roc)) < 1e-4 and abs(th - float(th_roc)) < 1e-6
+
+
+if __name__ == '__main__':
+    main()
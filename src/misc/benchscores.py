@@ -0,0 +1,101 @@
+import time
+
+import torch
+import torch.nn.functional as F
+
+from eer import Cohort, compute_scores
+
+
+def compute_scores_loop(embeddings, trials):
+    # the previous implementation, one device sync per trial
+    scores = []
+
+    for (enrollment, test) in trials:
+        e_e = embeddings[enrollment]
+        e_t = embeddings[test]
+
+        score = F.cosine_similarity(e_e.view(1, -1), e_t.view(1, -1)).item()
+
+        scores.append(score)
+
+    return torch.tensor(scores)
+
+
+def make_trials(num_keys, num_trials, dim=192, device='cpu'):
+    keys = [f'{i:06d}' for i in range(num_keys)]
+    embeddings = {key: torch.randn(dim, device=device) for key in keys}
+
+    index = torch.randint(num_keys, (num_trials, 2)).tolist()
+    trials = [(keys[e], keys[t]) for e, t in index]
+
+    return embeddings, trials
+
+
+def measure(f, *args, **kwargs):
+    start_time = time.time()
+    result = f(*args, **kwargs)
+    end_time = time.time()
+    return result, end_time - start_time
+
+
+def as_norm_loop(embeddings, trials, cohort, top_k):
+    # AS-norm with the cohort statistics recomputed for both sides of every trial
+    cohort = F.normalize(cohort, dim=1)
+    scores = []
+
+    for enrollment, test in trials:
+        e_e = F.normalize(embeddings[enrollment], dim=0)
+        e_t = F.normalize(embeddings[test], dim=0)
+
+        score = e_e @ e_t
+        top_e = torch.topk(cohort @ e_e, top_k).values
+        top_t = torch.topk(cohort @ e_t, top_k).values
+
+        scores.append(0.5 * ((score - top_e.mean()) / top_e.std() + (score - top_t.mean()) / top_t.std()))
+
+    return torch.stack(scores)
+
+
+def main():
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+
+    for num_trials in [14_600, 100_000, 1_000_000]:
+        embeddings, trials = make_trials(5_000, num_trials, device=device)
+
+        batched, t_batched = measure(compute_scores, embeddings, trials)
+        print(f'batched: {num_trials} trials in {t_batched:.3f}s on {device}.')
+
+        # the loop takes minutes beyond this size
+        if num_trials <= 100_000:
+            loop, t_loop = measure(compute_scores_loop, embeddings, trials)
+            error = torch.max(torch.abs(loop - batched)).item()
+            print(f'loop:    {num_trials} trials in {t_loop:.3f}s on {device} ({t_loop / t_batched:.1f}x, max error {error:.2e}).')
+
+
+def main_as_norm():
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    cohort = torch.randn(10_000, 192, device=device)
+
+    embeddings, trials = make_trials(5_000, 1_000)
+    loop, t_loop = measure(as_norm_loop, embeddings, trials, cohort, 300)
+
+    normalized = Cohort(cohort, top_k=300)
+    batched, t_batched = measure(compute_scores, embeddings, trials, cohort=normalized)
+
+    error = torch.max(torch.abs(loop - batched)).item()
+    print(f'AS-norm loop:    {len(trials)} trials in {t_loop:.3f}s (max error {error:.2e}).')
+    print(f'AS-norm batched: {len(trials)} trials in {t_batched:.3f}s ({t_loop / t_batched:.1f}x).')
+
+    embeddings, trials = make_trials(5_000, 1_000_000, device=device)
+
+    normalized = Cohort(cohort, top_k=300)
+    _, t_first = measure(compute_scores, embeddings, trials, cohort=normalized)
+    _, t_again = measure(compute_scores, embeddings, trials, cohort=normalized)
+
+    print(f'AS-norm: {len(trials)} trials against {len(cohort)} cohort embeddings in {t_first:.3f}s, '
+          f'{t_again:.3f}s with cached statistics on {device}.')
+
+
+if __name__ == '__main__':
+    main()
+    main_as_norm()
@@ -0,0 +1,85 @@
+import os
+import warnings
+
+import torch
+import torch.distributed as dist
+
+
+class EmbeddingCollector:
+    # Embeddings are written into a preallocated (num_keys, dim) buffer indexed by the
+    # position of each key in `keys`, then all-gathered once across ranks.
+    def __init__(self, keys: list[str], dim: int = 192, device='cpu'):
+        self.keys = keys
+        self.index = {key: i for i, key in enumerate(keys)}
+
+        self.embeddings = torch.zeros(len(keys), dim, device=device)
+        self.found = torch.zeros(len(keys), device=device)
+
+    @torch.no_grad()
+    def update(self, keys: list[str], embeddings: torch.Tensor) -> None:
+        # utterances which are not part of any trial are dropped
+        pairs = [(i, self.index[key]) for i, key in enumerate(keys) if key in self.index]
+
+        if not pairs:
+            return
+
+        src, dst = zip(*pairs)
+        src = torch.tensor(src, device=embeddings.device)
+        dst = torch.tensor(dst, device=self.embeddings.device)
+
+        self.embeddings.index_copy_(0, dst, embeddings.detach().index_select(0, src).to(self.embeddings))
+        self.found.index_fill_(0, dst, 1)
+
+    @torch.no_grad()
+    def gather(self) -> torch.Tensor:
+        embeddings, found = self.embeddings, self.found
+
+        if dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1:
+            world_size = dist.get_world_size()
+
+            all_embeddings = [torch.empty_like(embeddings) for _ in range(world_size)]
+            all_found = [torch.empty_like(found) for _ in range(world_size)]
+
+            dist.all_gather(all_embeddings, embeddings)
+            dist.all_gather(all_found, found)
+
+            # a key seen by several ranks is averaged
+            found = torch.stack(all_found).sum(0)
+            embeddings = torch.stack(all_embeddings).sum(0) / found.clamp(min=1).unsqueeze(1)
+
+        missing = int((found == 0).sum())
+
+        if missing > 0:
+            warnings.warn(f'{missing} of {len(self.keys)} utterances have no embedding')
+
+        return embeddings
+
+
+def _check(rank, world_size, keys, embeddings):
+    os.environ['MASTER_ADDR'] = 'localhost'
+    os.environ['MASTER_PORT'] = '29500'
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
+
+    collector = EmbeddingCollector(keys, embeddings.size(1))
+
+    # every rank sees its own shard in its own order
+    shard = list(range(rank, len(keys), world_size))[::-1]
+    for start in range(0, len(shard), 3):
+        index = shard[start:start + 3]
+        collector.update([keys[i] for i in index] + ['unknown'], torch.cat((embeddings[index], embeddings[:1])))
+
+    gathered = collector.gather()
+    assert torch.equal(gathered, embeddings), f'rank {rank}: gathered embeddings differ'
+
+    dist.destroy_process_group()
+
+
+if __name__ == '__main__':
+    import torch.multiprocessing as mp
+
+    world_size = 4
+    keys = [f'{i:04d}' for i in range(37)]
+    embeddings = torch.randn(len(keys), 192)
+
+    mp.spawn(_check, args=(world_size, keys, embeddings), nprocs=world_size)
+    print(f'gathered {len(keys)} embeddings from {world_size} gloo processes.')
@@ -1,8 +1,9 @@
-from typing import Tuple
+import struct
+from typing import NamedTuple, Optional, Tuple
 
+import numpy as np
 import torch
 import torch.nn.functional as F
-import torchmetrics
 
 
 def read_trials(path: str) -> Tuple[list[int], list[Tuple[str, str]]]:
@@ -18,31 +19,299 @@ def read_trials(path: str) -> Tuple[list[int], list[Tuple[str, str]]]:
     return torch.tensor(labels), trials
 
 
-def compute_scores(embeddings: dict[str, torch.Tensor], trials: list[Tuple[str, str]]):
-    scores = []
+# compiled trial list written by `data/maketrials.py`:
+# header, '\n'-joined key vocabulary padded to 8 bytes, int32 enrollment, int32 test, int8 labels
+TRIALS_MAGIC = b'SVTRIAL1'
+TRIALS_HEADER = '<8sqqq'
 
-    for (enrollment, test) in trials:
-        e_e = embeddings[enrollment]
-        e_t = embeddings[test]
 
-        score = F.cosine_similarity(e_e.view(1, -1), e_t.view(1, -1)).item()
+class Trials(NamedTuple):
+    keys: list[str]
+    enrollment: np.ndarray
+    test: np.ndarray
+    labels: np.ndarray
 
-        scores.append(score)
+    def __len__(self):
+        return len(self.labels)
 
-    return torch.tensor(scores)
 
+def load_trials(path: str) -> Trials:
+    if not path.endswith('.bin'):
+        labels, trials = read_trials(path)
+        keys = sorted({key for trial in trials for key in trial})
+        enrollment, test = index_trials(keys, trials)
+        return Trials(keys, enrollment.int().numpy(), test.int().numpy(), labels.char().numpy())
 
-def compute_eer(scores, labels) -> Tuple[float, float]:
-    fpr, tpr, thresholds = torchmetrics.functional.roc(scores, labels, pos_label=1)
-    fnr = 1 - tpr
+    # arrays are read-only views into the mapped file
+    buffer = np.memmap(path, dtype=np.uint8, mode='r')
+
+    magic, num_keys, num_trials, vocab_size = struct.unpack_from(TRIALS_HEADER, buffer)
+
+    if magic != TRIALS_MAGIC:
+        raise ValueError(f'{path} is not a compiled trial list')
+
+    offset = struct.calcsize(TRIALS_HEADER)
+    keys = bytes(buffer[offset:offset + vocab_size]).decode('utf-8').split('\n')
+    offset += -(-vocab_size // 8) * 8
+
+    enrollment = np.frombuffer(buffer, dtype=np.int32, count=num_trials, offset=offset)
+    offset += 4 * num_trials
+    test = np.frombuffer(buffer, dtype=np.int32, count=num_trials, offset=offset)
+    offset += 4 * num_trials
+    labels = np.frombuffer(buffer, dtype=np.int8, count=num_trials, offset=offset)
+
+    assert len(keys) == num_keys
+
+    return Trials(keys, enrollment, test, labels)
+
+
+def stack_embeddings(embeddings: dict[str, torch.Tensor], keys: Optional[list[str]] = None) -> Tuple[list[str], torch.Tensor]:
+    if keys is None:
+        keys = list(embeddings.keys())
+
+    matrix = torch.stack([embeddings[key].flatten() for key in keys])
+
+    # normalize once so that a cosine similarity is a plain dot product
+    return keys, F.normalize(matrix, dim=1)
+
+
+def index_trials(keys: list[str], trials: list[Tuple[str, str]]) -> Tuple[torch.Tensor, torch.Tensor]:
+    index = {key: i for i, key in enumerate(keys)}
+
+    enrollment = torch.tensor([index[e] for e, _ in trials], dtype=torch.long)
+    test = torch.tensor([index[t] for _, t in trials], dtype=torch.long)
+
+    return enrollment, test
+
+
+@torch.no_grad()
+def score_trials(
+    matrix: torch.Tensor,
+    enrollment: torch.Tensor,
+    test: torch.Tensor,
+    chunk_size: int = 2 ** 16
+) -> torch.Tensor:
+    # `matrix` must be L2-normalized. Only `chunk_size` pairs are gathered at once,
+    # so the temporaries stay bounded even for millions of trials.
+    enrollment = enrollment.to(matrix.device)
+    test = test.to(matrix.device)
+
+    scores = torch.empty(len(enrollment), dtype=matrix.dtype, device=matrix.device)
+
+    for start in range(0, len(enrollment), chunk_size):
+        end = start + chunk_size
+        e_e = matrix.index_select(0, enrollment[start:end])
+        e_t = matrix.index_select(0, test[start:end])
+        scores[start:end] = torch.sum(e_e * e_t, dim=1)
+
+    # single device sync for the whole trial list
+    return scores.cpu()
+
+
+class Cohort:
+    # Cohort embeddings for adaptive symmetric score normalization (AS-norm), normalized once.
+    # The mean and std of the `top_k` highest cohort scores of an utterance are computed once
+    # per unique utterance, `chunk_size` utterances per matmul, and cached by key, so a Cohort
+    # serves the embeddings of one checkpoint.
+    def __init__(self, embeddings: torch.Tensor, top_k: int = 300, chunk_size: int = 1024):
+        self.matrix = F.normalize(embeddings.float(), dim=1)
+        self.top_k = min(top_k, len(self.matrix))
+        self.chunk_size = chunk_size
+
+        self.index = {}
+        self.mean = torch.empty(0)
+        self.std = torch.empty(0)
+
+    @torch.no_grad()
+    def stats(self, keys: list[str], matrix: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        # `matrix` holds the L2-normalized embeddings of `keys`, only unseen keys are scored
+        missing = [i for i, key in enumerate(keys) if key not in self.index]
+
+        if missing:
+            rows = torch.tensor(missing, device=matrix.device)
+            mean = torch.empty(len(missing))
+            std = torch.empty(len(missing))
+
+            for start in range(0, len(missing), self.chunk_size):
+                end = start + self.chunk_size
+                embeddings = matrix.index_select(0, rows[start:end]).to(self.matrix)
+
+                # (chunk, cohort) scores, the only large temporary
+                top = torch.topk(embeddings @ self.matrix.T, self.top_k, dim=1).values
+
+                mean[start:end] = top.mean(dim=1).cpu()
+                std[start:end] = top.std(dim=1).cpu()
+
+            for i in missing:
+                self.index[keys[i]] = len(self.index)
+
+            self.mean = torch.cat((self.mean, mean))
+            self.std = torch.cat((self.std, std))
+
+        index = torch.tensor([self.index[key] for key in keys], dtype=torch.long)
+
+        return self.mean[index], self.std[index]
+
+
+def as_norm(
+    scores: torch.Tensor,
+    enrollment: torch.Tensor,
+    test: torch.Tensor,
+    mean: torch.Tensor,
+    std: torch.Tensor
+) -> torch.Tensor:
+    # per-trial statistics are gathered from the per-utterance ones
+    return 0.5 * ((scores - mean[enrollment]) / std[enrollment] + (scores - mean[test]) / std[test])
+
+
+def compute_scores(embeddings, trials, chunk_size: int = 2 ** 16, cohort: Optional[Cohort] = None):
+    # `embeddings` is either a dict of key to embedding or a `misc.store.EmbeddingStore`,
+    # `trials` is either a `Trials` or a list of (enrollment, test) keys.
+    # With a `Cohort`, scores are AS-normalized.
+    if isinstance(trials, Trials):
+        keys = trials.keys
+        enrollment = torch.from_numpy(trials.enrollment.astype(np.int64))
+        test = torch.from_numpy(trials.test.astype(np.int64))
+    else:
+        keys = sorted({key for trial in trials for key in trial})
+        enrollment, test = index_trials(keys, trials)
+
+    if isinstance(embeddings, dict):
+        _, matrix = stack_embeddings(embeddings, keys)
+    else:
+        matrix = F.normalize(embeddings.matrix(keys), dim=1)
+
+    scores = score_trials(matrix, enrollment, test, chunk_size)
+
+    if cohort is not None:
+        scores = as_norm(scores, enrollment, test, *cohort.stats(keys, matrix))
+
+    return scores
+
+
+def _roc(scores: torch.Tensor, labels: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    # false/true positive counts at every distinct score, highest threshold first,
+    # starting from (0, 0) like `torchmetrics.functional.roc`
+    scores, order = torch.sort(scores, descending=True)
+    labels = (labels[order] == 1).float()
+
+    distinct = torch.nonzero(scores[1:] != scores[:-1]).flatten()
+    last = torch.tensor([len(scores) - 1], device=scores.device)
+    index = torch.cat((distinct, last))
+
+    tps = torch.cumsum(labels, dim=0)[index]
+    fps = 1 + index - tps
+
+    zero = tps.new_zeros(1)
+    thresholds = torch.cat((scores[:1] + 1, scores[index]))
+
+    return torch.cat((zero, fps)), torch.cat((zero, tps)), thresholds
+
+
+def _eer(fps, tps, thresholds) -> Tuple[float, float]:
+    fpr = fps / fps[-1]
+    fnr = 1 - tps / tps[-1]
 
     fnr = fnr * 100
     fpr = fpr * 100
 
     opt = torch.argmin(torch.abs((fnr - fpr)))
-    eer = max(fpr[opt], fnr[opt])
+    eer = torch.maximum(fpr[opt], fnr[opt])
+
+    return eer.item(), thresholds[opt].item()
+
+
+def _min_dcf(fps, tps, thresholds, p_target=0.01, c_miss=1.0, c_fa=1.0) -> Tuple[float, float]:
+    fpr = fps.double() / fps[-1]
+    fnr = 1 - tps.double() / tps[-1]
+
+    dcf = c_miss * p_target * fnr + c_fa * (1 - p_target) * fpr
+    # normalized by the cost of the best trivial system
+    dcf = dcf / min(c_miss * p_target, c_fa * (1 - p_target))
+
+    opt = torch.argmin(dcf)
+
+    return dcf[opt].item(), thresholds[opt].item()
+
+
+def compute_eer(scores, labels) -> Tuple[float, float]:
+    return _eer(*_roc(scores, labels))
+
+
+def compute_min_dcf(scores, labels, p_target=0.01, c_miss=1.0, c_fa=1.0) -> Tuple[float, float]:
+    return _min_dcf(*_roc(scores, labels), p_target, c_miss, c_fa)
+
+
+def compute_metrics(scores, labels, operating_points=((0.01, 1.0, 1.0), (0.001, 1.0, 1.0))) -> dict[str, float]:
+    # one sort shared by the EER and every (p_target, c_miss, c_fa) operating point
+    roc = _roc(scores, labels)
+    return _summarize(roc, operating_points)
+
+
+def _summarize(roc, operating_points) -> dict[str, float]:
+    eer, threshold = _eer(*roc)
+    metrics = {'eer': eer, 'eer_threshold': threshold}
+
+    for p_target, c_miss, c_fa in operating_points:
+        min_dcf, threshold = _min_dcf(*roc, p_target, c_miss, c_fa)
+        metrics[f'min_dcf@{p_target}'] = min_dcf
+        metrics[f'min_dcf@{p_target}_threshold'] = threshold
+
+    return metrics
+
+
+class StreamingMetrics:
+    # Scores are accumulated into fixed-width histograms, so memory does not grow with
+    # the number of trials. Thresholds are resolved to the bin width, (high - low) / num_bins.
+    # Scores have to lie in [low, high]: the default fits cosine scores, normalized scores such
+    # as AS-norm need a wider range. Scores outside it by more than a bin raise a ValueError.
+    def __init__(self, low=-1.0, high=1.0, num_bins=2 ** 20, operating_points=((0.01, 1.0, 1.0), (0.001, 1.0, 1.0))):
+        self.low = low
+        self.high = high
+        self.num_bins = num_bins
+        self.operating_points = operating_points
+
+        self.positives = torch.zeros(num_bins, dtype=torch.long)
+        self.negatives = torch.zeros(num_bins, dtype=torch.long)
+
+    @torch.no_grad()
+    def update(self, scores: torch.Tensor, labels: torch.Tensor) -> None:
+        scores = scores.double()
+
+        # rounding error of cosine scores falls into the edge bins
+        width = (self.high - self.low) / self.num_bins
+        outside = ~((scores >= self.low - width) & (scores <= self.high + width))
+
+        if outside.any():
+            raise ValueError(
+                f'{int(outside.sum())} scores outside [{self.low}, {self.high}], '
+                f'e.g. {float(scores[outside][0])}; widen low and high to cover them'
+            )
+
+        bins = (scores - self.low) * (self.num_bins / (self.high - self.low))
+        bins = bins.long().clamp(0, self.num_bins - 1).cpu()
+        labels = labels.cpu() == 1
+
+        self.positives += torch.bincount(bins[labels], minlength=self.num_bins)
+        self.negatives += torch.bincount(bins[~labels], minlength=self.num_bins)
+
+    def reset(self) -> None:
+        self.positives.zero_()
+        self.negatives.zero_()
+
+    def roc(self) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        # accept every score at or above the lower edge of a bin, highest bin first
+        zero = torch.zeros(1, dtype=torch.double)
+        tps = torch.cat((zero, torch.cumsum(self.positives.flip(0), dim=0).double()))
+        fps = torch.cat((zero, torch.cumsum(self.negatives.flip(0), dim=0).double()))
+
+        edges = torch.linspace(self.low, self.high, self.num_bins + 1, dtype=torch.double)
+        thresholds = torch.cat((edges[-1:] + 1, edges[:-1].flip(0)))
+
+        return fps, tps, thresholds
 
-    return eer, thresholds[opt]
+    def compute(self) -> dict[str, float]:
+        return _summarize(self.roc(), self.operating_points)
 
 
 if __name__ == '__main__':
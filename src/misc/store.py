@@ -0,0 +1,110 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+import torch
+
+
+def checkpoint_hash(path: str, length: int = 16) -> str:
+    digest = hashlib.sha256()
+
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(2 ** 20), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest()[:length]
+
+
+class EmbeddingStore:
+    # root/<checkpoint hash>/
+    #   meta.json       dim and dtype
+    #   keys.txt        one utterance key per row
+    #   embeddings.bin  raw (rows, dim) matrix, appended in batches
+    def __init__(self, root: str, checkpoint: str, dim: int = 192, dtype: str = 'float16', read_only: bool = False):
+        self.path = os.path.join(root, checkpoint)
+        self.read_only = read_only
+
+        meta = os.path.join(self.path, 'meta.json')
+
+        if read_only and not os.path.exists(meta):
+            raise FileNotFoundError(f'No embedding store at {self.path}')
+
+        os.makedirs(self.path, exist_ok=True)
+
+        if os.path.exists(meta):
+            with open(meta) as f:
+                meta = json.load(f)
+            dim, dtype = meta['dim'], meta['dtype']
+        else:
+            with open(meta, 'w') as f:
+                json.dump({'dim': dim, 'dtype': dtype}, f)
+
+        self.dim = dim
+        self.dtype = np.dtype(dtype)
+
+        self.keys = []
+        self.index = {}
+
+        # bytes of keys.txt holding committed keys
+        self.keys_size = 0
+
+        if os.path.exists(self.keys_path):
+            with open(self.keys_path, 'rb') as f:
+                lines = f.read().split(b'\n')
+
+            # a last line without a newline was cut short, and keys past the last complete
+            # row were never committed
+            for line in lines[:-1][:self.num_rows()]:
+                self.index[line.decode('utf-8')] = len(self.keys)
+                self.keys.append(line.decode('utf-8'))
+                self.keys_size += len(line) + 1
+
+    @property
+    def keys_path(self):
+        return os.path.join(self.path, 'keys.txt')
+
+    @property
+    def matrix_path(self):
+        return os.path.join(self.path, 'embeddings.bin')
+
+    def num_rows(self) -> int:
+        if not os.path.exists(self.matrix_path):
+            return 0
+        return os.path.getsize(self.matrix_path) // (self.dim * self.dtype.itemsize)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def append(self, keys: list[str], embeddings: torch.Tensor) -> None:
+        if self.read_only:
+            raise PermissionError(f'Embedding store at {self.path} is read-only')
+
+        rows = embeddings.detach().float().cpu().numpy().astype(self.dtype)
+        lines = ''.join(key + '\n' for key in keys).encode('utf-8')
+
+        # truncate partially written tails before appending
+        with open(self.matrix_path, 'ab') as f:
+            f.truncate(len(self.keys) * self.dim * self.dtype.itemsize)
+            f.write(rows.tobytes())
+
+        with open(self.keys_path, 'ab') as f:
+            f.truncate(self.keys_size)
+            f.write(lines)
+
+        self.keys_size += len(lines)
+
+        for key in keys:
+            self.index[key] = len(self.keys)
+            self.keys.append(key)
+
+    def mmap(self) -> np.ndarray:
+        return np.memmap(self.matrix_path, dtype=self.dtype, mode='r', shape=(len(self.keys), self.dim))
+
+    def matrix(self, keys: list[str]) -> torch.Tensor:
+        # only the requested rows are read from the mapped file
+        rows = np.array([self.index[key] for key in keys], dtype=np.int64)
+        return torch.from_numpy(self.mmap()[rows].astype(np.float32))
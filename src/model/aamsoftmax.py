@@ -2,13 +2,14 @@ import math
 
 import torch
 import torch.nn.functional as F
+import torch.utils.checkpoint
 
 
 class AAMsoftmax(torch.nn.Module):
-    def __init__(self, n_class, m, s):
+    def __init__(self, n_class, m, s, embedding_size=192):
         super(AAMsoftmax, self).__init__()
 
-        self.weight = torch.nn.Parameter(torch.FloatTensor(n_class, 192), requires_grad=True)
+        self.weight = torch.nn.Parameter(torch.FloatTensor(n_class, embedding_size), requires_grad=True)
         self.ce = torch.nn.CrossEntropyLoss()
 
         self.m = m
@@ -21,11 +22,14 @@ class AAMsoftmax(torch.nn.Module):
 
         torch.nn.init.xavier_normal_(self.weight, gain=1)
 
+    def margin(self, cosine):
+        sine = torch.sqrt((1.0 - cosine * cosine).clamp(0, 1))
+        phi = cosine * self.cos_m - sine * self.sin_m
+        return torch.where((cosine - self.th) > 0, phi, cosine - self.mm)
+
     def forward(self, x, label=None):
         cosine = F.linear(F.normalize(x), F.normalize(self.weight))
-        sine = torch.sqrt((1.0 - torch.mul(cosine, cosine)).clamp(0, 1))
-        phi = cosine * self.cos_m - sine * self.sin_m
-        phi = torch.where((cosine - self.th) > 0, phi, cosine - self.mm)
+        phi = self.margin(cosine)
 
         one_hot = torch.zeros_like(cosine)
         one_hot.scatter_(1, label.view(-1, 1), 1)
@@ -36,3 +40,84 @@ class AAMsoftmax(torch.nn.Module):
         loss = self.ce(output, label)
 
         return loss
+
+
+class FusedAAMsoftmax(AAMsoftmax):
+    # Same loss and gradients as `AAMsoftmax`, with the same parameters. The margin is applied
+    # to the (batch, 1) target cosines only, and the (batch, n_class) logits are reduced to a
+    # logsumexp over the other classes. With `chunk_size`, classes are scored in slices that are
+    # recomputed in the backward pass, so at most (batch, chunk_size) logits exist at a time.
+    def __init__(self, n_class, m, s, embedding_size=192, chunk_size=None):
+        super(FusedAAMsoftmax, self).__init__(n_class, m, s, embedding_size)
+
+        self.chunk_size = chunk_size
+
+    def others(self, x, weight, label, start):
+        # logsumexp of the scaled cosines of the classes weight[start:start + len(weight)],
+        # except the target class
+        logits = F.linear(x, F.normalize(weight)).mul_(self.s)
+
+        index = label - start
+        rows = ((index >= 0) & (index < weight.size(0))).nonzero().squeeze(1)
+
+        # finite, so that a slice holding only the target class still has a gradient
+        logits.index_put_((rows, index[rows]), logits.new_tensor(torch.finfo(logits.dtype).min))
+
+        return torch.logsumexp(logits, dim=1)
+
+    def forward(self, x, label=None):
+        x = F.normalize(x)
+
+        target = self.margin((x * F.normalize(self.weight[label])).sum(dim=1)) * self.s
+
+        if self.chunk_size is None:
+            others = [self.others(x, self.weight, label, 0)]
+        else:
+            others = [
+                torch.utils.checkpoint.checkpoint(
+                    self.others, x, self.weight[start:start + self.chunk_size], label, start, use_reentrant=False
+                )
+                for start in range(0, self.weight.size(0), self.chunk_size)
+            ]
+
+        lse = torch.logsumexp(torch.stack([target, *others], dim=1), dim=1)
+
+        return (lse - target).mean()
+
+
+class SubCenterAAMsoftmax(AAMsoftmax):
+    # `centers` weights per class, each class scored by its closest center, so that noisy
+    # samples can sit on a center of their own. With `top_k`, the inter-top-k penalty: the
+    # `top_k` hardest other classes of each sample get an extra margin `m_top` towards it.
+    def __init__(self, n_class, m, s, embedding_size=192, centers=3, top_k=0, m_top=0.06):
+        super(SubCenterAAMsoftmax, self).__init__(n_class * centers, m, s, embedding_size)
+
+        self.n_class = n_class
+        self.centers = centers
+        self.top_k = top_k
+        self.m_top = m_top
+
+        self.cos_m_top = math.cos(self.m_top)
+        self.sin_m_top = math.sin(self.m_top)
+
+    def forward(self, x, label=None):
+        cosine = F.linear(F.normalize(x), F.normalize(self.weight))
+
+        if self.centers > 1:
+            cosine = cosine.view(-1, self.n_class, self.centers).max(dim=2).values
+
+        label = label.view(-1, 1)
+        logits = cosine
+
+        if self.top_k > 0:
+            # one batched topk over the cosines with the target class pushed out of reach
+            with torch.no_grad():
+                index = cosine.scatter(1, label, -2.0).topk(self.top_k, dim=1).indices
+
+            hard = cosine.gather(1, index)
+            sine = torch.sqrt((1.0 - hard * hard).clamp(0, 1))
+            logits = logits.scatter(1, index, hard * self.cos_m_top + sine * self.sin_m_top)
+
+        logits = logits.scatter(1, label, self.margin(cosine.gather(1, label)))
+
+        return F.cross_entropy(logits * self.s, label.view(-1))
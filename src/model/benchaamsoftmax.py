@@ -0,0 +1,92 @@
+import time
+
+import torch
+
+from aamsoftmax import AAMsoftmax, FusedAAMsoftmax, SubCenterAAMsoftmax
+
+
+def peak_memory(prof):
+    # highest sum of live CPU allocations over the profiled step, in the order they happened
+    current = peak = 0
+
+    for event in sorted(prof.events(), key=lambda event: event.time_range.start):
+        current += event.self_cpu_memory_usage
+        peak = max(peak, current)
+
+    return peak
+
+
+def step(loss, x, label):
+    x = x.detach().requires_grad_()
+    loss.zero_grad(set_to_none=True)
+
+    value = loss(x, label)
+    value.backward()
+
+    return value.detach(), x.grad, loss.weight.grad
+
+
+def measure(loss, x, label, repeat=5):
+    step(loss, x, label)
+
+    start_time = time.time()
+
+    for _ in range(repeat):
+        step(loss, x, label)
+
+    end_time = time.time()
+
+    with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU], profile_memory=True) as prof:
+        step(loss, x, label)
+
+    return (end_time - start_time) / repeat, peak_memory(prof)
+
+
+def main():
+    batch_size = 128
+
+    for n_class in [2338, 100_000]:
+        x = torch.randn(batch_size, 192)
+        label = torch.randint(n_class, (batch_size,))
+
+        reference = AAMsoftmax(n_class, 0.2, 30)
+
+        losses = {
+            'AAMsoftmax': reference,
+            'FusedAAMsoftmax': FusedAAMsoftmax(n_class, 0.2, 30),
+            'FusedAAMsoftmax (chunks of 16384)': FusedAAMsoftmax(n_class, 0.2, 30, chunk_size=16384),
+        }
+
+        expected = step(reference, x, label)
+
+        print(f'{n_class} classes, batch of {batch_size}:')
+
+        for name, loss in losses.items():
+            loss.load_state_dict(reference.state_dict())
+
+            # same loss, and same gradients for the embeddings and the class weights
+            for a, b in zip(step(loss, x, label), expected):
+                assert torch.allclose(a, b, rtol=1e-4, atol=1e-6), name
+
+            seconds, peak = measure(loss, x, label)
+            print(f'  {name}: {seconds * 1000:.1f}ms forward + backward, {peak / 2 ** 20:.0f}MiB peak on CPU')
+
+        # one center and no penalty is plain AAM-softmax
+        loss = SubCenterAAMsoftmax(n_class, 0.2, 30, centers=1)
+        loss.load_state_dict(reference.state_dict())
+
+        for a, b in zip(step(loss, x, label), expected):
+            assert torch.allclose(a, b, rtol=1e-4, atol=1e-6), 'SubCenterAAMsoftmax'
+
+        variants = {
+            'SubCenterAAMsoftmax (3 centers)': SubCenterAAMsoftmax(n_class, 0.2, 30, centers=3),
+            'SubCenterAAMsoftmax (3 centers, top 5)': SubCenterAAMsoftmax(n_class, 0.2, 30, centers=3, top_k=5),
+        }
+
+        for name, loss in variants.items():
+            seconds, peak = measure(loss, x, label)
+            print(f'  {name}: {seconds * 1000:.1f}ms forward + backward, {peak / 2 ** 20:.0f}MiB peak on CPU')
+
+
+if __name__ == '__main__':
+    main()
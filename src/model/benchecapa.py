@@ -0,0 +1,178 @@
+import time
+import types
+
+import torch
+
+from benchaamsoftmax import peak_memory
+from ecapa import ECAPATDNN, Res2Block
+
+
+def res2block_reference(self, x):
+    # Res2Block.forward as it was, growing the output with one torch.cat per branch
+    residual = x
+
+    x = self.conv1(x)
+
+    xs = torch.split(x, self.width, 1)
+    x = 0
+    y = xs[-1]
+
+    for i in range(max(1, self.scale - 1)):
+        x = x + xs[i]
+        x = self.res2bns[i](self.relu(self.res2convs[i](x)))
+        y = torch.cat((y, x), 1)
+
+    y = self.conv3(y)
+    y = self.se(y)
+
+    return y + residual
+
+
+def pooling_reference(self, x, mask=None):
+    # ECAPATDNN's pooling as it was, on the repeated (batch, 4608, frames) global statistics
+    if mask is not None:
+        mask = mask.unsqueeze(1)
+
+    def __compute_stats(x, w, dim=2):
+        if mask is None:
+            m = torch.mean(w * x, dim=dim, keepdim=True)
+            s = torch.sqrt(torch.clamp(torch.sum((x**2) * w, dim=2, keepdim=True) - m ** 2, 1e-6))
+        else:
+            w = w * mask
+            m = torch.sum(w * x, dim=dim, keepdim=True) / mask.sum(dim=dim, keepdim=True)
+            s = torch.sqrt(torch.clamp(torch.sum((x**2) * w, dim=2, keepdim=True) - m ** 2, 1e-6))
+        return m, s
+
+    mean, std = __compute_stats(x, torch.ones_like(x))
+
+    global_stat = torch.cat((x, mean.repeat(1, 1, x.size(-1)), std.repeat(1, 1, x.size(-1))), dim=1)
+
+    if mask is None:
+        attention = self.attention(global_stat)
+    else:
+        attention = self.attention[:-1](global_stat)
+        attention = self.attention[-1](attention.masked_fill(~mask, float('-inf')))
+
+    mean, std = __compute_stats(x, attention)
+
+    return torch.cat((mean, std), 1).flatten(1)
+
+
+class Pooling(torch.nn.Module):
+    # the pooling of `model` alone, on the output of its layer4
+    def __init__(self, model, forward, mask=None):
+        super().__init__()
+        self.model = model
+        self.forward_pooling = forward
+        self.mask = mask
+
+    def forward(self, x):
+        return self.forward_pooling(self.model, x, self.mask)
+
+
+def patched(block, forward):
+    # a copy of `block` running `forward`
+    copy = Res2Block(1024, 1024, kernel_size=3, dilation=2, scale=8).train(block.training)
+    copy.load_state_dict(block.state_dict())
+    copy.forward = types.MethodType(forward, copy)
+    return copy
+
+
+def train_step(model, x):
+    model.zero_grad(set_to_none=True)
+    y = model(x)
+    y.sum().backward()
+    return y.detach()
+
+
+@torch.no_grad()
+def infer(model, x):
+    return model(x)
+
+
+def measure(step, model, x, repeat=3):
+    step(model, x)
+
+    start_time = time.time()
+
+    for _ in range(repeat):
+        step(model, x)
+
+    end_time = time.time()
+
+    with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU], profile_memory=True) as prof:
+        step(model, x)
+
+    return (end_time - start_time) / repeat, peak_memory(prof)
+
+
+def compare(title, models, step, x):
+    print(f'{title}:')
+
+    results = {name: measure(step, model, x) for name, model in models.items()}
+    base_seconds, base_peak = next(iter(results.values()))
+
+    for name, (seconds, peak) in results.items():
+        print(
+            f'  {name}: {seconds * 1000:.0f}ms ({base_seconds / seconds:.2f}x), '
+            f'{peak / 2 ** 20:.0f}MiB peak ({(base_peak - peak) / 2 ** 20:+.0f}MiB saved)'
+        )
+
+
+def main():
+    torch.manual_seed(1234)
+    x = torch.randn(128, 80, 150)
+
+    model = ECAPATDNN()
+
+    # running statistics away from their initial values, so that eval mode is not trivial
+    with torch.no_grad():
+        model(x)
+        h = model.conv1(x)
+
+    block = model.layer1
+
+    for train in [True, False]:
+        block.train(train)
+
+        blocks = {
+            'repeated torch.cat': patched(block, res2block_reference),
+            'Res2Block': block,
+        }
+
+        step = train_step if train else infer
+        outputs = [step(b, h) for b in blocks.values()]
+        assert torch.allclose(outputs[0], outputs[1], rtol=1e-4, atol=1e-4)
+
+        title = f'Res2Block, {"training" if train else "inference"}, {tuple(h.shape)} from {tuple(x.shape)} on CPU'
+        compare(title, blocks, step, h)
+
+    with torch.no_grad():
+        h = model.relu(model.layer4(torch.cat((h, h, h), dim=1)))
+
+    # a third of the frames padded away in half of the batch
+    lengths = torch.where(torch.arange(h.size(0)) % 2 == 0, h.size(-1), h.size(-1) * 2 // 3)
+    mask = torch.arange(h.size(-1)) < lengths.unsqueeze(1)
+
+    for train in [True, False]:
+        model.train(train)
+        step = train_step if train else infer
+
+        for m in [None, mask]:
+            poolings = {
+                'repeated global statistics': Pooling(model, pooling_reference, m),
+                'ECAPATDNN.pooling': Pooling(model, ECAPATDNN.pooling, m),
+            }
+
+            outputs = [step(p, h) for p in poolings.values()]
+            assert torch.allclose(outputs[0], outputs[1], rtol=1e-4, atol=1e-4)
+
+            title = (
+                f'Attentive statistics pooling, {"training" if train else "inference"}, '
+                f'{tuple(h.shape)}{" with a mask" if m is not None else ""} on CPU'
+            )
+            compare(title, poolings, step, h)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+import time
+
+import torch
+import torchaudio
+
+from frontend import LogMelFrontend, compile_frontend
+
+
+def measure(fbank, x, repeat=20):
+    with torch.no_grad():
+        fbank(x)
+
+        start_time = time.time()
+
+        for _ in range(repeat):
+            y = fbank(x)
+
+        end_time = time.time()
+
+    return repeat * y.size(0) * y.size(-1) / (end_time - start_time)
+
+
+def main():
+    x = torch.randn(128, int(1.5 * 16000))
+
+    fbanks = {
+        'MelSpectrogram': torchaudio.transforms.MelSpectrogram(
+            sample_rate=16000,
+            n_fft=512,
+            win_length=int(0.025 * 16000),
+            hop_length=int(0.010 * 16000),
+            n_mels=80
+        ),
+        'LogMelFrontend': LogMelFrontend(),
+        'LogMelFrontend (channels last)': LogMelFrontend(channels_last=True),
+        'LogMelFrontend (bfloat16)': LogMelFrontend(dtype=torch.bfloat16),
+        'LogMelFrontend (jit)': compile_frontend(LogMelFrontend(), 'jit'),
+    }
+
+    if hasattr(torch, 'compile'):
+        fbanks['LogMelFrontend (compile)'] = compile_frontend(LogMelFrontend(), 'compile')
+
+    for name, fbank in fbanks.items():
+        print(f'{name}: {measure(fbank, x):.0f} frames/s on CPU')
+
+
+if __name__ == '__main__':
+    main()
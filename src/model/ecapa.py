@@ -1,3 +1,5 @@
+from typing import Optional
+
 import torch
 import torch.nn.functional as F
 
@@ -48,6 +50,12 @@ class ConvReLUBN(torch.nn.Module):
         return self.bn(self.relu(self.conv(x)))
 
 
+def batchnorm_affine(bn: torch.nn.BatchNorm1d):
+    # an eval-mode BatchNorm as a per-channel scale and shift
+    scale = bn.weight * torch.rsqrt(bn.running_var + bn.eps)
+    return scale.unsqueeze(1), (bn.bias - bn.running_mean * scale).unsqueeze(1)
+
+
 class Res2Block(torch.nn.Module):
     def __init__(self, inplane: int, planes: int, kernel_size: int = 3, dilation: int = 2, scale: int = 8) -> None:
         super().__init__()
@@ -82,13 +90,29 @@ class Res2Block(torch.nn.Module):
         x = self.conv1(x)
 
         xs = torch.split(x, self.width, 1)
-        x = 0
-        y = xs[-1]
 
-        for i in range(max(1, self.scale - 1)):
-            x = x + xs[i]
-            x = self.res2bns[i](self.relu(self.res2convs[i](x)))
-            y = torch.cat((y, x), 1)
+        if self.training or torch.is_grad_enabled():
+            # concatenated once instead of once per branch, the backward pass only slices
+            x = 0
+            ys = [xs[-1]]
+
+            for i in range(max(1, self.scale - 1)):
+                x = x + xs[i]
+                x = self.res2bns[i](self.relu(self.res2convs[i](x)))
+                ys.append(x)
+
+            y = torch.cat(ys, 1)
+        else:
+            # Inference: each branch ends in its slice of the output. The BatchNorm follows the
+            # ReLU, so it cannot fold into the conv; it is applied as a scale and shift instead.
+            y = torch.empty_like(x)
+            y[:, :self.width] = xs[-1]
+
+            for i in range(max(1, self.scale - 1)):
+                x = xs[0] if i == 0 else x + xs[i]
+                scale, shift = batchnorm_affine(self.res2bns[i])
+                out = y[:, (i + 1) * self.width:(i + 2) * self.width]
+                x = torch.addcmul(shift.to(x.dtype), self.relu(self.res2convs[i](x)), scale.to(x.dtype), out=out)
 
         y = self.conv3(y)
         y = self.se(y)
@@ -121,7 +145,46 @@ class ECAPATDNN(torch.nn.Module):
         self.fc5 = torch.nn.Linear(outfeats * 8 * 2, outfeats)
         self.bn6 = torch.nn.BatchNorm1d(outfeats)
 
-    def forward(self, x: torch.Tensor) -> torch.Tensor:
+    def pooling(self, x: torch.Tensor, mask: Optional[torch.Tensor] = None) -> torch.Tensor:
+        # Attentive statistics pooling. The first attention conv sees each frame next to the
+        # utterance mean and std repeated over frames; its weights are split instead, into a
+        # per-frame conv and a per-utterance term broadcast over frames.
+        channels = x.size(1)
+
+        if mask is None:
+            count = x.new_full((x.size(0), 1), x.size(-1))
+            valid = x
+        else:
+            mask = mask.unsqueeze(1)
+            count = mask.sum(dim=2).to(x.dtype)
+            valid = x * mask
+
+        # as before: the mean over valid frames, and the sum of squares minus the squared mean
+        mean = valid.sum(dim=2) / count
+        std = torch.sqrt(torch.clamp(torch.linalg.vector_norm(valid, dim=2) ** 2 - mean ** 2, 1e-6))
+
+        weight = self.attention[0].weight.squeeze(2)
+        utterance = torch.addmm(self.attention[0].bias, torch.cat((mean, std), dim=1), weight[:, channels:].t())
+
+        attention = F.conv1d(x, weight[:, :channels].unsqueeze(2)) + utterance.unsqueeze(2)
+        attention = self.attention[1:-1](attention)
+
+        if mask is not None:
+            # softmax over the valid frames only
+            attention = attention.masked_fill(~mask, float('-inf'))
+
+        attention = self.attention[-1](attention)
+
+        # padded frames have no attention, and without a mask the weighted sum is averaged
+        # over frames as before
+        weighted = x * attention
+        mean = weighted.sum(dim=2) / (count if mask is not None else x.size(-1))
+        std = torch.sqrt(torch.clamp((weighted * x).sum(dim=2) - mean ** 2, 1e-6))
+
+        return torch.cat((mean, std), dim=1)
+
+    def forward(self, x: torch.Tensor, mask: Optional[torch.Tensor] = None) -> torch.Tensor:
+        # `mask` is a (batch, frames) boolean tensor, False on padded frames
         x = self.conv1(x)
 
         x1 = self.layer1(x)
@@ -132,19 +195,7 @@ class ECAPATDNN(torch.nn.Module):
 
         x = self.relu(self.layer4(x))
 
-        def __compute_stats(x, w, dim=2):
-            m = torch.mean(w * x, dim=dim, keepdim=True)
-            s = torch.sqrt(torch.clamp(torch.sum((x**2) * w, dim=2, keepdim=True) - m ** 2, 1e-6))
-            return m, s
-
-        mean, std = __compute_stats(x, torch.ones_like(x))
-
-        global_stat = torch.cat((x, mean.repeat(1, 1, x.size(-1)), std.repeat(1, 1, x.size(-1))), dim=1)
-        attention = self.attention(global_stat)
-
-        mean, std = __compute_stats(x, attention)
-
-        x = torch.cat((mean, std), 1).flatten(1)
+        x = self.pooling(x, mask)
 
         x = self.bn5(x)
         x = self.fc5(x)
@@ -0,0 +1,112 @@
+import copy
+
+import torch
+
+from model.ecapa import ECAPATDNN, batchnorm_affine
+
+
+class Pointwise(torch.nn.Module):
+    # a kernel size 1 Conv1d as a Linear over channels, which dynamic quantization supports
+    def __init__(self, conv: torch.nn.Conv1d) -> None:
+        super().__init__()
+
+        self.linear = torch.nn.Linear(conv.in_channels, conv.out_channels, bias=conv.bias is not None)
+        self.linear.weight.data.copy_(conv.weight.data.squeeze(2))
+
+        if conv.bias is not None:
+            self.linear.bias.data.copy_(conv.bias.data)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        return self.linear(x.transpose(1, 2)).transpose(1, 2)
+
+
+@torch.no_grad()
+def fold_into_next(bn, layer):
+    # layer(bn(x)) with bn folded into the weights of a Linear or kernel size 1 Conv1d
+    scale, shift = (t.squeeze(1) for t in batchnorm_affine(bn))
+    weight = layer.weight.view(layer.weight.size(0), -1)
+
+    bias = weight @ shift
+    if layer.bias is not None:
+        bias = bias + layer.bias
+
+    layer.weight.mul_(scale.view(1, -1, *[1] * (layer.weight.dim() - 2)))
+    layer.bias = torch.nn.Parameter(bias)
+
+
+@torch.no_grad()
+def fold_into_previous(layer, bn):
+    # bn(layer(x)) with bn folded into the weights of a Linear
+    scale, shift = (t.squeeze(1) for t in batchnorm_affine(bn))
+
+    bias = layer.bias if layer.bias is not None else torch.zeros_like(shift)
+
+    layer.weight.mul_(scale.unsqueeze(1))
+    layer.bias = torch.nn.Parameter(bias * scale + shift)
+
+
+def fold_batchnorm(embedding: ECAPATDNN) -> ECAPATDNN:
+    # An eval-mode copy of `embedding` with every BatchNorm that sits next to a linear layer
+    # folded into it: bn5 and bn6 around fc5, and the attention BatchNorm into the conv after
+    # it. The other BatchNorms follow a ReLU and feed residuals or splits, so they stay.
+    embedding = copy.deepcopy(embedding).eval()
+
+    fold_into_next(embedding.attention[2], embedding.attention[3])
+    embedding.attention[2] = torch.nn.Identity()
+
+    fold_into_next(embedding.bn5, embedding.fc5)
+    embedding.bn5 = torch.nn.Identity()
+
+    fold_into_previous(embedding.fc5, embedding.bn6)
+    embedding.bn6 = torch.nn.Identity()
+
+    return embedding
+
+
+def pointwise_to_linear(module: torch.nn.Module, keep=()) -> torch.nn.Module:
+    # kernel size 1 convs replaced in place by `Pointwise`, except those in `keep`
+    for name, child in module.named_children():
+        if isinstance(child, torch.nn.Conv1d) and child.kernel_size == (1,) and child not in keep:
+            setattr(module, name, Pointwise(child))
+        else:
+            pointwise_to_linear(child, keep)
+
+    return module
+
+
+class Extractor(torch.nn.Module):
+    # waveforms and their lengths in samples to embeddings, frontend included
+    def __init__(self, fbank: torch.nn.Module, embedding: torch.nn.Module) -> None:
+        super().__init__()
+
+        self.fbank = fbank
+        self.embedding = embedding
+        self.hop_length = fbank.hop_length
+
+    def forward(self, x: torch.Tensor, lengths: torch.Tensor) -> torch.Tensor:
+        x = self.fbank(x, lengths)
+
+        # frames of a centered STFT over `lengths` samples, as in `SVSystem.forward`
+        frames = torch.div(lengths, self.hop_length, rounding_mode='floor') + 1
+        mask = torch.arange(x.size(-1), device=x.device) < frames.unsqueeze(1)
+
+        return self.embedding(x, mask)
+
+
+@torch.no_grad()
+def export(fbank, embedding, quantize=False, example=(2, 3 * 16000)):
+    # a traced extractor with folded BatchNorm, and optionally dynamic int8 linear layers
+    embedding = fold_batchnorm(embedding)
+
+    if quantize:
+        # `ECAPATDNN.pooling` splits the weights of the first attention conv, so it stays a conv
+        embedding = pointwise_to_linear(embedding, keep=[embedding.attention[0]])
+        embedding = torch.ao.quantization.quantize_dynamic(embedding, {torch.nn.Linear}, dtype=torch.qint8)
+
+    extractor = Extractor(copy.deepcopy(fbank).eval(), embedding).eval()
+
+    x = torch.randn(*example)
+    lengths = torch.tensor([example[1]] * (example[0] - 1) + [example[1] // 2])
+
+    # traced under no_grad, so the inference paths are recorded; lengths and batch stay dynamic
+    return torch.jit.freeze(torch.jit.trace(extractor, (x, lengths), check_trace=False))
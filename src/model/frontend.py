@@ -0,0 +1,101 @@
+import io
+from typing import Optional
+
+import numpy as np
+import torch
+import torchaudio
+
+
+class LogMelFrontend(torch.nn.Module):
+    # Log-mel filterbank with the window and the mel projection precomputed as buffers.
+    # Output is (batch, n_mels, frames) like `torchaudio.transforms.MelSpectrogram`.
+    compute_dtype: Optional[torch.dtype]
+
+    def __init__(
+        self,
+        sample_rate: int = 16000,
+        n_fft: int = 512,
+        win_length: int = int(0.025 * 16000),
+        hop_length: int = int(0.010 * 16000),
+        n_mels: int = 80,
+        eps: float = 1e-6,
+        mean_norm: bool = True,
+        channels_last: bool = False,
+        dtype: Optional[torch.dtype] = None,
+    ) -> None:
+        super().__init__()
+
+        self.n_fft = n_fft
+        self.win_length = win_length
+        self.hop_length = hop_length
+        self.eps = eps
+        self.mean_norm = mean_norm
+        self.channels_last = channels_last
+        self.compute_dtype = dtype
+
+        self.register_buffer('window', torch.hann_window(win_length), persistent=False)
+
+        # (n_fft // 2 + 1, n_mels), same filters as `MelSpectrogram`
+        fb = torchaudio.functional.melscale_fbanks(n_fft // 2 + 1, 0.0, sample_rate / 2, n_mels, sample_rate)
+        self.register_buffer('fb', fb, persistent=False)
+
+    def forward(self, x: torch.Tensor, lengths: Optional[torch.Tensor] = None) -> torch.Tensor:
+        # `lengths` in samples of zero padded waveforms, so that the mean excludes padding.
+        # The STFT itself always runs in float32
+        spec = torch.stft(
+            x.float(),
+            self.n_fft,
+            hop_length=self.hop_length,
+            win_length=self.win_length,
+            window=self.window,
+            center=True,
+            pad_mode='reflect',
+            return_complex=True,
+        )
+
+        power = spec.real ** 2 + spec.imag ** 2
+
+        dtype = self.compute_dtype
+        if dtype is None:
+            dtype = power.dtype
+
+        # (batch, frames, freq) @ (freq, n_mels) -> (batch, frames, n_mels)
+        mel = torch.matmul(power.transpose(1, 2).to(dtype), self.fb.to(dtype))
+        mel = torch.log(mel + self.eps)
+
+        if self.mean_norm:
+            if lengths is None:
+                mel = mel - mel.mean(dim=1, keepdim=True)
+            else:
+                # frames of a centered STFT over `lengths` samples
+                frames = torch.div(lengths, self.hop_length, rounding_mode='floor') + 1
+                frames = frames.to(mel.device).view(-1, 1, 1)
+
+                mask = torch.arange(mel.size(1), device=mel.device).view(1, -1, 1) < frames
+                mel = mel - (mel * mask).sum(dim=1, keepdim=True) / frames.to(mel.dtype)
+
+        # channels-last keeps the frames-major memory layout of the projection and
+        # only returns a transposed view
+        if self.channels_last:
+            return mel.transpose(1, 2)
+
+        return mel.transpose(1, 2).contiguous()
+
+
+def compile_frontend(frontend: torch.nn.Module, mode: str = 'jit') -> torch.nn.Module:
+    if mode == 'jit':
+        return torch.jit.script(frontend)
+
+    if mode == 'compile':
+        if not hasattr(torch, 'compile'):
+            raise RuntimeError('torch.compile requires torch >= 2.0')
+        return torch.compile(frontend)
+
+    return frontend
+
+
+def encode_features(features: torch.Tensor) -> bytes:
+    # (n_mels, frames) float16 .npy, as stored in feature shards
+    buffer = io.BytesIO()
+    np.save(buffer, features.detach().cpu().numpy().astype(np.float16))
+    return buffer.getvalue()
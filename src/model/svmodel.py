@@ -1,6 +1,8 @@
 import pytorch_lightning as lightning
 import torch
-from misc.eer import compute_eer, compute_scores, read_trials
+import torch.nn.functional as F
+from misc.collector import EmbeddingCollector
+from misc.eer import compute_eer, load_trials, score_trials
 
 
 class SVSystem(lightning.LightningModule):
@@ -11,6 +13,7 @@ class SVSystem(lightning.LightningModule):
         loss,
         dev_trials=None,
         test_trials=None,
+        embedding_size=192,
     ) -> None:
         super().__init__()
 
@@ -21,10 +24,32 @@ class SVSystem(lightning.LightningModule):
         self.dev_trials = dev_trials
         self.test_trials = test_trials
 
-    def forward(self, x) -> torch.Tensor:
-        x = self.fbank(x)
-        x = self.embedding(x)
-        return x
+        self.embedding_size = embedding_size
+        self.collector = None
+
+        # parsed once, then reused every epoch
+        self._trials = {}
+
+    def trials(self, path):
+        if path not in self._trials:
+            self._trials[path] = load_trials(path)
+        return self._trials[path]
+
+    def forward(self, x, lengths=None) -> torch.Tensor:
+        # (batch, samples) waveforms, or (batch, n_mels, frames) precomputed features
+        if x.dim() == 2:
+            x = self.fbank(x, lengths)
+
+            if lengths is not None:
+                # frames of a centered STFT over `lengths` samples
+                lengths = torch.div(lengths, self.fbank.hop_length, rounding_mode='floor') + 1
+
+        if lengths is None:
+            return self.embedding(x)
+
+        mask = torch.arange(x.size(-1), device=x.device) < lengths.to(x.device).unsqueeze(1)
+
+        return self.embedding(x, mask)
 
     def configure_optimizers(self):
         optimizer = torch.optim.AdamW(self.parameters(), lr=1e-3)
@@ -52,38 +77,40 @@ class SVSystem(lightning.LightningModule):
         self.log("train_loss", loss)
         return loss
 
-    def validation_step(self, batch, batch_idx):
-        x, key = batch
-        emb = self(x)
-        emb = {key[i]: emb[i] for i in range(len(x))}
-        return emb
+    def evaluate(self, path):
+        trials = self.trials(path)
+        embeddings = self.collector.gather()
+        self.collector = None
 
-    def validation_epoch_end(self, output_results):
-        # merge all dicts in `emb`
-        emb = {}
-        for output in output_results:
-            emb |= output
+        eer = None
 
-        labels, trials = read_trials(self.dev_trials)
-        scores = compute_scores(emb, trials)
-        eer, threshold = compute_eer(scores, labels)
+        # scored once on rank 0, then shared with the other ranks
+        if self.trainer.is_global_zero:
+            enrollment = torch.from_numpy(trials.enrollment.astype('int64'))
+            test = torch.from_numpy(trials.test.astype('int64'))
+            labels = torch.from_numpy(trials.labels.astype('int64'))
 
-        self.log('val_eer', eer)
+            scores = score_trials(F.normalize(embeddings, dim=1), enrollment, test)
+            eer, threshold = compute_eer(scores, labels)
 
-    def test_step(self, batch, batch_idx):
-        x, key = batch
-        emb = self(x)
-        emb = {key[i]: emb[i] for i in range(len(x))}
-        return emb
+        return self.trainer.strategy.broadcast(eer)
 
-    def test_epoch__end(self, output_results):
-        # merge all dicts in `emb`
-        emb = {}
-        for output in output_results:
-            emb |= output
+    def on_validation_epoch_start(self):
+        self.collector = EmbeddingCollector(self.trials(self.dev_trials).keys, self.embedding_size, self.device)
+
+    def validation_step(self, batch, batch_idx):
+        x, lengths, key = batch
+        self.collector.update(key, self(x, lengths))
 
-        labels, trials = read_trials(self.dev_trials)
-        scores = compute_scores(emb, trials)
-        eer, threshold = compute_eer(scores, labels)
+    def validation_epoch_end(self, output_results):
+        self.log('val_eer', self.evaluate(self.dev_trials))
+
+    def on_test_epoch_start(self):
+        self.collector = EmbeddingCollector(self.trials(self.test_trials).keys, self.embedding_size, self.device)
+
+    def test_step(self, batch, batch_idx):
+        x, lengths, key = batch
+        self.collector.update(key, self(x, lengths))
 
-        self.log('test_eer', eer)
+    def test_epoch_end(self, output_results):
+        self.log('test_eer', self.evaluate(self.test_trials))
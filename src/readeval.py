@@ -0,0 +1,64 @@
+import time
+
+import torch
+import torchaudio
+import webdataset
+
+from data.librispeech import bucket_by_length, flac_handler_soundfile
+from model.ecapa import ECAPATDNN
+
+
+def padding_waste(batches):
+    # fraction of padded samples which are computed but thrown away
+    total = sum(x.numel() for x, lengths, keys in batches)
+    valid = sum(int(lengths.sum()) for x, lengths, keys in batches)
+    return 1 - valid / total
+
+
+@torch.no_grad()
+def throughput(model, fbank, batches):
+    count = 0
+    start_time = time.time()
+
+    for x, lengths, keys in batches:
+        frames = torch.div(lengths, fbank.hop_length, rounding_mode='floor') + 1
+        features = fbank(x)
+        mask = torch.arange(features.size(-1)) < frames.unsqueeze(1)
+        model(features, mask)
+        count += x.size(0)
+
+    end_time = time.time()
+
+    return count / (end_time - start_time)
+
+
+def main():
+    url = "data/materials/webdataset/shards/librespeech-dev-000000.tar"
+    batch_size = 16
+    limit = 512
+
+    dataset = webdataset.WebDataset(url) \
+        .decode(webdataset.handle_extension("flac", flac_handler_soundfile)) \
+        .to_tuple("waveform.flac", "__key__")
+
+    samples = [sample for _, sample in zip(range(limit), dataset)]
+
+    fbank = torchaudio.transforms.MelSpectrogram(
+        sample_rate=16000,
+        n_fft=512,
+        win_length=int(0.025 * 16000),
+        hop_length=int(0.010 * 16000),
+        n_mels=80
+    )
+    model = ECAPATDNN().eval()
+
+    # naive batching is bucketing with a window of a single batch
+    for name, window in [('naive', batch_size), ('bucketed', limit)]:
+        batches = list(bucket_by_length(samples, batch_size, window))
+        waste = padding_waste(batches)
+        speed = throughput(model, fbank, batches)
+        print(f'{name}: {speed:.2f} utterances/s, {waste * 100:.1f}% padding over {len(samples)} utterances from {url}.')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+import time
+
+import torch
+
+from train import make_modules
+from model.svmodel import SVSystem
+
+
+def measure(model, x, y, repeat=5):
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-3)
+
+    def step():
+        optimizer.zero_grad()
+        loss = model.loss(model(x), y)
+        loss.backward()
+        optimizer.step()
+
+    step()
+
+    start_time = time.time()
+
+    for _ in range(repeat):
+        step()
+
+    end_time = time.time()
+
+    return (end_time - start_time) / repeat
+
+
+def main():
+    batch_size = 32
+
+    fbank, embedding, loss = make_modules()
+    model = SVSystem(fbank, embedding, loss)
+
+    y = torch.randint(2338, (batch_size,))
+
+    waveforms = torch.randn(batch_size, int(1.5 * 16000))
+    features = torch.randn(batch_size, 80, 150)
+
+    print(f'waveform input: {measure(model, waveforms, y):.3f}s per step on CPU')
+    print(f'feature input:  {measure(model, features, y):.3f}s per step on CPU')
+
+
+if __name__ == '__main__':
+    main()
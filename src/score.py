@@ -0,0 +1,49 @@
+import argparse
+import os
+import time
+
+import torch
+
+from misc.eer import Cohort, compute_metrics, compute_scores, load_trials
+from misc.store import EmbeddingStore, checkpoint_hash
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Score trial lists against an embedding store.')
+    parser.add_argument('checkpoint', help='checkpoint file or its hash')
+    parser.add_argument('trials', nargs='+')
+    parser.add_argument('--store', default='data/artifacts/embeddings')
+    parser.add_argument('--cohort', help='file of cohort utterance keys in the store, one per line, for AS-norm')
+    parser.add_argument('--top-k', type=int, default=300, help='cohort scores kept per utterance')
+    args = parser.parse_args()
+
+    if os.path.isfile(args.checkpoint):
+        checkpoint = checkpoint_hash(args.checkpoint)
+    else:
+        checkpoint = args.checkpoint
+
+    store = EmbeddingStore(args.store, checkpoint, read_only=True)
+
+    cohort = None
+
+    if args.cohort is not None:
+        with open(args.cohort) as f:
+            keys = f.read().split()
+
+        # shared by every trial list, so utterances in several lists are normalized once
+        cohort = Cohort(store.matrix(keys), args.top_k)
+
+    for path in args.trials:
+        start_time = time.time()
+
+        trials = load_trials(path)
+        scores = compute_scores(store, trials, cohort=cohort)
+        metrics = compute_metrics(scores, torch.from_numpy(trials.labels.astype('int64')))
+
+        end_time = time.time()
+
+        print(f'{path}: {metrics} ({len(trials)} trials in {end_time - start_time:.3f}s)')
+
+
+if __name__ == '__main__':
+    main()
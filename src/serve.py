@@ -0,0 +1,291 @@
+import argparse
+import asyncio
+import base64
+import collections
+import io
+import json
+
+import soundfile
+import torch
+import torch.nn.functional as F
+
+from data.librispeech import pad_batch
+from embed import load
+from misc.eer import score_trials
+from model.export import export
+from train import make_modules
+
+
+REASONS = {
+    200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 500: 'Internal Server Error'
+}
+
+SAMPLE_RATE = 16000
+
+
+class Batcher:
+    # Requests wait for one forward pass together, until `max_batch` of them are queued or
+    # `max_wait` seconds have passed since the first. Passes run one at a time in a thread, so
+    # requests arriving during a pass make up the next one.
+    def __init__(self, module, max_batch=32, max_wait=0.01):
+        self.module = module
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+
+        self.queue = asyncio.Queue()
+        self.batches = 0
+        self.requests = 0
+
+    async def embed(self, waveform):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((waveform, future))
+        return await future
+
+    @torch.no_grad()
+    def forward(self, waveforms):
+        x, lengths, _ = pad_batch([(waveform, None) for waveform in waveforms])
+        return F.normalize(self.module(x, lengths), dim=1)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+
+        while True:
+            items = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+
+            while len(items) < self.max_batch:
+                timeout = deadline - loop.time()
+
+                if timeout <= 0:
+                    break
+
+                try:
+                    items.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            self.batches += 1
+            self.requests += len(items)
+
+            try:
+                embeddings = await loop.run_in_executor(None, self.forward, [waveform for waveform, _ in items])
+            except Exception:
+                # one bad request fails only itself: the batch is retried one request at a time
+                await self.run_each(items)
+                continue
+
+            for (_, future), embedding in zip(items, embeddings):
+                if not future.done():
+                    future.set_result(embedding)
+
+    async def run_each(self, items):
+        loop = asyncio.get_running_loop()
+
+        for waveform, future in items:
+            try:
+                embedding = (await loop.run_in_executor(None, self.forward, [waveform]))[0]
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+                continue
+
+            if not future.done():
+                future.set_result(embedding)
+
+
+class SpeakerCache:
+    # enrolled speaker embeddings, the least recently used evicted beyond `budget` bytes
+    def __init__(self, budget=64 * 2 ** 20):
+        self.budget = budget
+        self.size = 0
+        self.embeddings = collections.OrderedDict()
+        self.evictions = 0
+
+    def get(self, speaker):
+        embedding = self.embeddings.get(speaker)
+
+        if embedding is not None:
+            self.embeddings.move_to_end(speaker)
+
+        return embedding
+
+    def put(self, speaker, embedding):
+        if speaker in self.embeddings:
+            self.size -= self.nbytes(self.embeddings.pop(speaker))
+
+        self.embeddings[speaker] = embedding
+        self.size += self.nbytes(embedding)
+
+        while self.size > self.budget and len(self.embeddings) > 1:
+            _, evicted = self.embeddings.popitem(last=False)
+            self.size -= self.nbytes(evicted)
+            self.evictions += 1
+
+    @staticmethod
+    def nbytes(embedding):
+        return embedding.numel() * embedding.element_size()
+
+    def __len__(self):
+        return len(self.embeddings)
+
+
+def decode(body):
+    # {"speaker": id, "audio": base64 of a mono 16 kHz audio file}
+    request = json.loads(body)
+    waveform, sample_rate = soundfile.read(io.BytesIO(base64.b64decode(request['audio'])), dtype='float32')
+
+    if waveform.ndim != 1:
+        raise ValueError(f'expected mono audio, got {waveform.shape[1]} channels')
+
+    if sample_rate != SAMPLE_RATE:
+        raise ValueError(f'expected {SAMPLE_RATE} Hz audio, got {sample_rate} Hz')
+
+    return str(request['speaker']), torch.from_numpy(waveform)
+
+
+class Server:
+    # POST /enroll and POST /verify with {"speaker", "audio"}, GET /stats
+    def __init__(self, module, max_batch=32, max_wait=0.01, budget=64 * 2 ** 20):
+        self.batcher = Batcher(module, max_batch, max_wait)
+        self.cache = SpeakerCache(budget)
+
+    async def enroll(self, speaker, waveform):
+        self.cache.put(speaker, await self.batcher.embed(waveform))
+        return 200, {'speaker': speaker, 'enrolled': len(self.cache)}
+
+    async def verify(self, speaker, waveform):
+        enrolled = self.cache.get(speaker)
+
+        # checked before the forward pass, which unknown speakers do not need
+        if enrolled is None:
+            return 404, {'error': f'speaker {speaker} is not enrolled'}
+
+        embedding = await self.batcher.embed(waveform)
+        score = score_trials(torch.stack([enrolled, embedding]), torch.tensor([0]), torch.tensor([1]))
+
+        return 200, {'speaker': speaker, 'score': float(score[0])}
+
+    def stats(self):
+        return 200, {
+            'batches': self.batcher.batches,
+            'requests': self.batcher.requests,
+            'mean_batch_size': self.batcher.requests / max(1, self.batcher.batches),
+            'enrolled': len(self.cache),
+            'cache_bytes': self.cache.size,
+            'evictions': self.cache.evictions,
+        }
+
+    async def route(self, method, path, body):
+        if path == '/stats':
+            return self.stats()
+
+        if path not in ['/enroll', '/verify']:
+            return 404, {'error': f'no route {path}'}
+
+        if method != 'POST':
+            return 405, {'error': f'{method} {path}'}
+
+        try:
+            speaker, waveform = await asyncio.get_running_loop().run_in_executor(None, decode, body)
+        except Exception as e:
+            return 400, {'error': f'bad request: {e}'}
+
+        try:
+            if path == '/enroll':
+                return await self.enroll(speaker, waveform)
+
+            return await self.verify(speaker, waveform)
+        except Exception as e:
+            return 500, {'error': f'{type(e).__name__}: {e}'}
+
+    async def respond(self, writer, status, result):
+        payload = json.dumps(result).encode('utf-8')
+
+        writer.write(
+            f'HTTP/1.1 {status} {REASONS[status]}\r\n'
+            f'Content-Type: application/json\r\n'
+            f'Content-Length: {len(payload)}\r\n\r\n'.encode('latin-1') + payload
+        )
+        await writer.drain()
+
+    async def handle(self, reader, writer):
+        # minimal HTTP/1.1 with keep-alive, one request at a time per connection
+        try:
+            while True:
+                line = await reader.readline()
+
+                if not line:
+                    break
+
+                try:
+                    method, path, _ = line.decode('latin-1').split(' ', 2)
+                    headers = {}
+
+                    while True:
+                        header = await reader.readline()
+
+                        if header in [b'\r\n', b'\n', b'']:
+                            break
+
+                        name, value = header.decode('latin-1').split(':', 1)
+                        headers[name.strip().lower()] = value.strip()
+
+                    length = int(headers.get('content-length', 0))
+
+                    if length < 0:
+                        raise ValueError(f'negative Content-Length {length}')
+                except ValueError as e:
+                    # the end of a malformed request is unknown, so the connection is closed
+                    await self.respond(writer, 400, {'error': f'malformed request: {e}'})
+                    break
+
+                body = await reader.readexactly(length)
+
+                status, result = await self.route(method, path, body)
+                await self.respond(writer, status, result)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host='127.0.0.1', port=8000):
+        server = await asyncio.start_server(self.handle, host, port)
+        batcher = asyncio.create_task(self.batcher.run())
+
+        print(f'Serving on {host}:{port}.')
+
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher.cancel()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve speaker enrollment and verification over HTTP.')
+    parser.add_argument('checkpoint', help='Lightning checkpoint or exported TorchScript file, or "untrained"')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--max-batch', type=int, default=32)
+    parser.add_argument('--max-wait', type=float, default=0.01, help='seconds a request waits for a batch')
+    parser.add_argument('--cache-budget', type=int, default=64 * 2 ** 20, help='bytes of enrolled embeddings')
+    parser.add_argument('--threads', type=int, default=None, help='intra-op threads')
+    parser.add_argument('--quantize', action='store_true', help='dynamic int8 linear layers')
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    if args.checkpoint == 'untrained':
+        # random weights, for load tests without a trained model
+        fbank, embedding, _ = make_modules()
+        module = export(fbank, embedding, args.quantize)
+    else:
+        module = load(args.checkpoint, args.quantize)
+
+    server = Server(module, args.max_batch, args.max_wait, args.cache_budget)
+    asyncio.run(server.serve(args.host, args.port))
+
+
+if __name__ == '__main__':
+    main()
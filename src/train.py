@@ -1,5 +1,3 @@
-import torch
-import torchaudio
 import pytorch_lightning as lightning
 
 from pytorch_lightning.callbacks import LearningRateMonitor, ModelCheckpoint
@@ -7,10 +5,26 @@ from pytorch_lightning.loggers import WandbLogger
 
 from data.librispeech import LibriSpeech
 from model.ecapa import ECAPATDNN
+from model.frontend import LogMelFrontend
 from model.svmodel import SVSystem
 from model.aamsoftmax import AAMsoftmax
 
 
+def make_modules():
+    fbank = LogMelFrontend(
+        sample_rate=16000,
+        n_fft=512,
+        win_length=int(0.025 * 16000),
+        hop_length=int(0.010 * 16000),
+        n_mels=80
+    )
+
+    embedding = ECAPATDNN()
+    loss = AAMsoftmax(2338, 0.2, 30)
+
+    return fbank, embedding, loss
+
+
 def main():
     # datamodule = LibriSpeech(
     #     'data/materials/webdataset/shards/librespeech-train-{000000..000058}.tar',
@@ -26,23 +40,14 @@ def main():
         batch_size=128,
     )
 
-    fbank = torchaudio.transforms.MelSpectrogram(
-        sample_rate=16000,
-        n_fft=512,
-        win_length=int(0.025 * 16000),
-        hop_length=int(0.010 * 16000),
-        n_mels=80
-    )
-
-    embedding = ECAPATDNN()
-    loss = AAMsoftmax(2338, 0.2, 30)
+    fbank, embedding, loss = make_modules()
 
     model = SVSystem(
         fbank,
         embedding,
         loss,
-        dev_trials='data/materials/dev-trials.txt',
-        test_trials='data/materials/test-trials.txt'
+        dev_trials='data/materials/dev-trials.bin',
+        test_trials='data/materials/test-trials.bin'
     )
 
     # callbacks